@@ -1,22 +1,145 @@
 #!/usr/bin/env python
 
+from itertools import chain, islice
+
 from xbmcswift import xbmc, xbmcgui, Plugin
-from resources.lib.mubi import Mubi
+from resources.lib.config import (Settings, create_client,
+                                  create_image_cache, create_mubi,
+                                  create_prefetcher, create_resolver,
+                                  create_sync, create_tracer, get_sort_key)
+from resources.lib.records import PAGE_SIZE
+from resources.lib.remote import MubiClient
 
 PLUGIN_NAME = 'MUBI'
 PLUGIN_ID = 'plugin.video.mubi'
+PROFILE_PATH = xbmc.translatePath('special://profile/addon_data/%s/'
+                                  % PLUGIN_ID)
 
 plugin = Plugin(PLUGIN_NAME, PLUGIN_ID, __file__)
+settings = Settings(plugin.get_setting)
 
 if not plugin.get_setting("username"):
     plugin.open_settings()
 
-mubi_session = Mubi()
-mubi_session.login(plugin.get_setting("username"),
-                   plugin.get_setting("password"))
+tracer = create_tracer(settings, PROFILE_PATH)
+
+
+def traced(func):
+    if tracer is None:
+        return func
+    return tracer.trace_route(func)
+
+
+# With the resident service running, the plugin only forwards calls to the
+# Mubi instance it keeps warm between invocations.
+mubi_session = create_client(settings)
+if mubi_session is None:
+    mubi_session = traced(create_mubi)(settings, PROFILE_PATH, tracer)
+images = create_image_cache(settings, PROFILE_PATH)
+resolver = create_resolver(settings, mubi_session)
+
+
+def thumbnails(urls):
+    if images is None:
+        return urls
+    return images.resolve(urls)
+
+
+def film_info(metadata):
+    """ Turn VideoMetadata into Kodi info labels. """
+    if metadata is None:
+        return {}
+    info = dict((key, value) for key, value in metadata._asdict().items()
+                if value is not None and key not in ('audio_language',
+                                                     'subtitle_language',
+                                                     'playcount'))
+    # MUBI's playcount is how often the film was watched on the site, Kodi
+    # would take it to mean the user has watched it
+    if metadata.playcount is not None:
+        info['votes'] = unicode(metadata.playcount)
+    # MUBI rates films from 0 to 5, Kodi from 0 to 10
+    if 'rating' in info:
+        info['rating'] = info['rating'] * 2
+    if 'cast' in info:
+        info['cast'] = list(info['cast'])
+    if 'year' in info:
+        try:
+            info['year'] = int(info['year'])
+        except ValueError:
+            del info['year']
+    return info
+
+
+def film_items(films):
+    # Only stored metadata is shown, whatever is missing is loaded in the
+    # background and shows up the next time the folder is displayed. Films
+    # are turned into items in batches, so that `films` can be a generator
+    # that is still fetching while the first items are built.
+    films = iter(films)
+    missing = []
+    while True:
+        batch = list(islice(films, PAGE_SIZE))
+        if not batch:
+            break
+        metadata = mubi_session.get_cached_metadata([x[1] for x in batch])
+        if resolver is not None:
+            missing.extend(resolver.missing([x[1] for x in batch], metadata))
+        for x, thumbnail in zip(batch,
+                                thumbnails([x.filmstill for x in batch])):
+            yield {'label': x[0], 'is_folder': False, 'is_playable': True,
+                   'url': plugin.url_for('play_film',
+                                         identifier=unicode(x[1])),
+                   'thumbnail': thumbnail,
+                   'info': film_info(metadata.get(int(x[1])))}
+    if resolver is not None:
+        resolver.start(missing)
+
+
+def sort_films(films):
+    return mubi_session.sort_films(films, get_sort_key(settings))
+
+
+# Film listings can be filtered by several of these at once, the URLs of
+# combined filters carry them as 'genre-3_country-12'
+FILTERS = ('genre', 'country', 'language')
+
+
+def decode_filters(filter, argument):
+    if filter in FILTERS:
+        return {filter: argument}
+    if filter == 'combined':
+        return dict(x.split('-', 1) for x in argument.split('_') if x)
+    return {}
+
+
+def films_url(filters, page):
+    if not filters:
+        filter, argument = 'all', '0'
+    elif len(filters) == 1:
+        filter, argument = list(filters.items())[0]
+    else:
+        filter = 'combined'
+        argument = "_".join("%s-%s" % (x, filters[x]) for x in FILTERS
+                            if x in filters)
+    return plugin.url_for('show_films', filter=filter,
+                          argument=unicode(argument), page=unicode(page))
+
+
+def filter_options(dimension, filters):
+    options = {'genre': mubi_session.genres,
+               'country': mubi_session.countries,
+               'language': mubi_session.languages}[dimension]
+    items = []
+    for name in sorted(options):
+        narrowed = dict(filters)
+        narrowed[dimension] = options[name]
+        items.append({'label': name, 'is_folder': True,
+                      'url': films_url(narrowed, 1)})
+    return items
 
 
 @plugin.route('/')
+@traced
 def index():
     items = [{'label': plugin.get_string(31001), 'is_folder': True,
               'url': plugin.url_for('select_filter')},
@@ -26,11 +149,56 @@ def index():
               'url': plugin.url_for('show_films', filter='watchlist',
                                     argument='0', page='1')},
              {'label': plugin.get_string(31004), 'is_folder': True,
-              'url': plugin.url_for('show_search_targets')}]
+              'url': plugin.url_for('show_search_targets')},
+             {'label': plugin.get_string(31016), 'is_folder': False,
+              'url': plugin.url_for('sync_catalog')}]
+    if tracer is not None:
+        items.append({'label': plugin.get_string(31018), 'is_folder': True,
+                      'url': plugin.url_for('show_stats')})
+    return plugin.add_items(items)
+
+
+@plugin.route('/stats')
+def show_stats():
+    items = []
+    # Tracing may have been turned off since the link was followed
+    if tracer is None:
+        return plugin.add_items(items)
+    for entry in tracer.summary():
+        label = (u"%s %s: %dx, %.2fs avg, %.2fs max"
+                 % (entry['type'], entry['name'], entry['count'],
+                    entry['mean'], entry['max']))
+        if entry['type'] == 'request':
+            label += (u", %.1f KB, %d cached"
+                      % (entry['bytes'] / 1024.0, entry['cached']))
+        items.append({'label': label, 'is_folder': False,
+                      'url': plugin.url_for('show_stats')})
     return plugin.add_items(items)
 
 
+@plugin.route('/sync')
+@traced
+def sync_catalog():
+    dialog = xbmcgui.DialogProgress()
+    dialog.create(plugin.get_string(30000), plugin.get_string(31017))
+
+    def progress(page, num_pages):
+        dialog.update(int(100 * page / num_pages), plugin.get_string(31017))
+        return not dialog.iscanceled()
+
+    try:
+        mubi = mubi_session
+        if isinstance(mubi, MubiClient):
+            # The catalog database is shared with the service, the update
+            # runs here so that it can report its progress
+            mubi = create_mubi(settings, PROFILE_PATH, tracer)
+        create_sync(settings, mubi).run(progress=progress)
+    finally:
+        dialog.close()
+
+
 @plugin.route('/films')
+@traced
 def select_filter():
     options = [{'label': plugin.get_string(31005), 'is_folder': True,
                 'url': plugin.url_for('show_films', filter='all',
@@ -45,25 +213,25 @@ def select_filter():
 
 
 @plugin.route('/cinemas')
+@traced
 def show_cinemas():
     cinemas = mubi_session.get_all_programs()
-    items = [{'label': x.title, 'is_folder': True, 'thumbnail': x.picture,
+    items = [{'label': x.title, 'is_folder': True, 'thumbnail': thumbnail,
               'url': plugin.url_for('show_cinema_films', cinema=x.identifier)}
-              for x in cinemas]
+              for x, thumbnail in zip(cinemas,
+                                      thumbnails([x.picture for x in cinemas]))]
     return plugin.add_items(items)
 
 
 @plugin.route('/cinemas/<cinema>')
+@traced
 def show_cinema_films(cinema):
-    films = mubi_session.get_program_films(cinema)
-    items = [{'label': x[0], 'is_folder': False, 'is_playable': True,
-              'thumbnail': x[2],
-              'url': plugin.url_for('play_film', identifier=x[1])}
-              for x in films]
-    return plugin.add_items(items)
+    films = sort_films(mubi_session.get_program_films(cinema))
+    return plugin.add_items(film_items(films))
 
 
 @plugin.route('/search')
+@traced
 def show_search_targets():
     targets = [{'label': plugin.get_string(31009), 'is_folder': True,
                 'url': plugin.url_for('show_search', target='film')},
@@ -73,6 +241,7 @@ def show_search_targets():
 
 
 @plugin.route('/search/<target>')
+@traced
 def show_search(target=None):
     if target == 'film':
         label = plugin.get_string(31013)
@@ -88,56 +257,64 @@ def show_search(target=None):
 
 
 @plugin.route('/search/<target>/<term>')
+@traced
 def show_search_results(target, term):
     if target == 'film':
-        results = mubi_session.search_film(term)
-        items = [{'label': x[0], 'is_folder': False, 'is_playable': True,
-                  'url': plugin.url_for('play_film', identifier=unicode(x[1])),
-                  'thumbnail': x[2]} for x in results]
-        return plugin.add_items(items)
+        lazy = settings.get_bool("lazy_availability")
+        results = sort_films(mubi_session.iter_search_film(
+            term, check_availability=not lazy))
+        return plugin.add_items(film_items(results))
     elif target == 'person':
         results = mubi_session.search_person(term)
         items = [{'label': x[0], 'is_folder': True,
                   'url': plugin.url_for('show_person_films',
                                         person=unicode(x[1])),
-                  'thumbnail': x[2]}
-                  for x in results]
+                  'thumbnail': thumbnail}
+                  for x, thumbnail in zip(results,
+                                          thumbnails([x.portrait
+                                                      for x in results]))]
         return plugin.add_items(items)
 
 
 @plugin.route('/persons/<person>')
+@traced
 def show_person_films(person):
-    films = mubi_session.get_person_films(person)
-    items = [{'label': x[0], 'is_folder': False, 'is_playable': True,
-              'url': plugin.url_for('play_film', identifier=x[1]),
-              'thumbnail': x[2]} for x in films]
-    return plugin.add_items(items)
+    films = sort_films(mubi_session.get_person_films(person))
+    return plugin.add_items(film_items(films))
 
 
 @plugin.route('/films/<filter>/<argument>/<page>')
+@traced
 def show_films(filter, argument, page):
     page = int(page)
-    if filter == 'all':
-        num_pages, films = mubi_session.get_all_films(page=page)
-    elif filter == 'watchlist':
-        films = mubi_session.get_watchlist()
+    filters = decode_filters(filter, argument)
+    sort_key = get_sort_key(settings)
+    if filter == 'watchlist':
+        films = sort_films(film for film, metadata
+                           in mubi_session.iter_watchlist())
         num_pages = 1
-    elif filter == 'genre':
-        num_pages, films = mubi_session.get_all_films(genre=argument,
-                                                      page=page)
-    elif filter == 'country':
-        num_pages, films = mubi_session.get_all_films(country=argument,
-                                                      page=page)
-    elif filter == 'language':
-        num_pages, films = mubi_session.get_all_films(language=argument,
-                                                      page=page)
-    items = [{'label': x[0], 'is_folder': False, 'is_playable': True,
-              'url': plugin.url_for('play_film', identifier=x[1]),
-              'thumbnail': x[2]}
-              for x in films]
-    if len(items) == 0:
+    else:
+        num_pages, films = mubi_session.iter_films_page(
+            page=page, per_page=settings.get_int("films_per_page", 100),
+            sort_key=sort_key, **filters)
+    films = iter(films)
+    first = next(films, None)
+    if first is None:
         xbmcgui.Dialog().ok(plugin.get_string(30000), plugin.get_string(31015))
         plugin.redirect(plugin.url_for('select_filter'))
+        films = []
+    else:
+        films = chain([first], films)
+    items = []
+    if filter != 'watchlist' and page == 1:
+        for label, dimension in zip((31019, 31020, 31021), FILTERS):
+            if dimension not in filters:
+                items.append({'label': plugin.get_string(label),
+                              'is_folder': True,
+                              'url': plugin.url_for('refine_films',
+                                                    dimension=dimension,
+                                                    filter=filter,
+                                                    argument=argument)})
     if page > 1:
         items.append({'label': plugin.get_string(31011), 'is_folder': True,
                       'url': plugin.url_for('show_films', filter=filter,
@@ -148,44 +325,42 @@ def show_films(filter, argument, page):
                       'url': plugin.url_for('show_films', filter=filter,
                                             argument=argument,
                                             page=unicode(page + 1))})
-    return plugin.add_items(items)
+    result = plugin.add_items(chain(film_items(films), items))
+    if filter != 'watchlist':
+        create_prefetcher(settings, mubi_session, images).start(
+            page, num_pages, sort_key=sort_key, **filters)
+    return result
+
+
+@plugin.route('/films/<filter>/<argument>/refine/<dimension>')
+@traced
+def refine_films(filter, argument, dimension):
+    return plugin.add_items(filter_options(dimension,
+                                           decode_filters(filter, argument)))
 
 
 @plugin.route('/play/<identifier>')
+@traced
 def play_film(identifier):
     return plugin.set_resolved_url(mubi_session.get_play_url(identifier))
 
 
 @plugin.route('/list/genres')
+@traced
 def show_genres():
-    items = [{'label': x, 'is_folder': True,
-              'url': plugin.url_for('show_films', filter='genre',
-                                     argument=unicode(mubi_session.genres[x]),
-                                     page='1')}
-              for x in sorted(mubi_session._CATEGORIES)]
-    return plugin.add_items(items)
+    return plugin.add_items(filter_options('genre', {}))
 
 
 @plugin.route('/list/countries')
+@traced
 def show_countries():
-    items = [{'label': x, 'is_folder': True,
-              'url': plugin.url_for('show_films', filter='country',
-                                     argument=unicode(mubi_session
-                                                      .countries[x]),
-                                     page='1')}
-              for x in sorted(mubi_session.countries)]
-    return plugin.add_items(items)
+    return plugin.add_items(filter_options('country', {}))
 
 
 @plugin.route('/list/languages')
+@traced
 def show_languages():
-    items = [{'label': x, 'is_folder': True,
-              'url': plugin.url_for('show_films', filter='language',
-                                     argument=unicode(mubi_session
-                                                      .languages[x]),
-                                     page='1')}
-              for x in sorted(mubi_session._LANGUAGES)]
-    return plugin.add_items(items)
+    return plugin.add_items(filter_options('language', {}))
 
 
 if __name__ == '__main__':
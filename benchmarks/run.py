@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Offline benchmarks for the MUBI scraper.
+
+Runs the scraping methods of `Mubi` against a local server that replays
+the pages in `fixtures/` and prints wall time, number of requests, bytes
+transferred and peak memory for each of them as JSON.
+
+    python benchmarks/run.py [--repeat N] [--extractor lxml|bs3]
+                             [--output FILE]
+"""
+
+import gc
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+import resource
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from benchmarks.server import FixtureServer, ReplayAdapter
+from resources.lib.extract import BS3Extractor, LxmlExtractor, get_extractor
+from resources.lib.mubi import Mubi
+
+USERNAME = 'benchmark@example.com'
+PASSWORD = 'secret'
+
+
+def login(mubi):
+    mubi.login(USERNAME, PASSWORD)
+
+
+# (name, setup, benchmark), setup is not measured
+BENCHMARKS = [
+    ('login', None, login),
+    ('get_all_films', login, lambda mubi: mubi.get_all_films(page=1)),
+    ('_parse_metadata', login, lambda mubi: mubi._parse_metadata(101)),
+    ('get_watchlist', login, lambda mubi: mubi.get_watchlist()),
+    # Time to the first item of the incremental variant
+    ('iter_watchlist', login, lambda mubi: next(mubi.iter_watchlist())),
+    ('search_film', login, lambda mubi: mubi.search_film('film')),
+    ('get_play_url', login, lambda mubi: mubi.get_play_url(101)),
+]
+
+EXTRACTORS = {'auto': get_extractor, 'lxml': LxmlExtractor,
+              'bs3': BS3Extractor}
+
+
+def _max_rss():
+    # ru_maxrss is in kilobytes on Linux, but in bytes on OS X
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _run_child(conn, extractor, port, index):
+    name, setup, benchmark = BENCHMARKS[index]
+    mubi = Mubi(extractor=EXTRACTORS[extractor]())
+    ReplayAdapter(port).mount(mubi._session)
+    if setup:
+        setup(mubi)
+    gc.collect()
+    # Let the parent reset the request counters after the setup
+    conn.send('ready')
+    conn.recv()
+    if tracemalloc:
+        tracemalloc.start()
+    else:
+        # The interpreter, the imports and the setup are in the peak
+        # already, only what the benchmark adds to it is reported
+        baseline = _max_rss()
+    start = time.time()
+    benchmark(mubi)
+    wall_time = time.time() - start
+    if tracemalloc:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        peak_memory = _max_rss() - baseline
+    conn.send((wall_time, peak_memory))
+    conn.close()
+
+
+def measure(server, extractor, index):
+    """ Run a benchmark in a child process of its own, so that its peak
+    memory isn't hidden by that of the benchmarks before it.
+    """
+    conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_run_child,
+                                      args=(child_conn, extractor,
+                                            server.port, index))
+    process.start()
+    child_conn.close()
+    try:
+        conn.recv()
+        server.reset()
+        conn.send('go')
+        wall_time, peak_memory = conn.recv()
+    except EOFError:
+        raise Exception("Benchmark '%s' failed" % BENCHMARKS[index][0])
+    finally:
+        process.join()
+    return {'wall_time': wall_time, 'requests': server.requests,
+            'bytes': server.bytes_sent, 'peak_memory': peak_memory}
+
+
+def run(repeat, extractor):
+    server = FixtureServer()
+    server.start()
+    results = []
+    for index, (name, setup, benchmark) in enumerate(BENCHMARKS):
+        samples = [measure(server, extractor, index) for _ in range(repeat)]
+        times = sorted(x['wall_time'] for x in samples)
+        results.append({'name': name,
+                        'wall_time': {'min': times[0],
+                                      'median': times[len(times) // 2],
+                                      'max': times[-1]},
+                        'requests': samples[-1]['requests'],
+                        'bytes': samples[-1]['bytes'],
+                        'peak_memory': max(x['peak_memory']
+                                           for x in samples)})
+    server.shutdown()
+    return {'timestamp': time.time(),
+            'python': platform.python_version(),
+            'extractor': type(EXTRACTORS[extractor]()).__name__,
+            'memory_method': ('tracemalloc' if tracemalloc
+                              else 'child maxrss growth'),
+            'repeat': repeat,
+            'results': results}
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-n', '--repeat', type='int', default=5,
+                      help="runs per benchmark [default: %default]")
+    parser.add_option('-e', '--extractor', choices=sorted(EXTRACTORS),
+                      default='auto',
+                      help="page parser to use [default: %default]")
+    parser.add_option('-o', '--output',
+                      help="write the results to a file instead of stdout")
+    options, args = parser.parse_args()
+    report = json.dumps(run(options.repeat, options.extractor), indent=2,
+                        sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            fp.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
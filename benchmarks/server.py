@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+""" Local stand-in for the MUBI website that replays the pages in
+`fixtures/`, counting requests and bytes sent.
+"""
+
+import io
+import os
+import re
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlsplit, urlunsplit
+
+from requests.adapters import HTTPAdapter
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fixtures')
+
+# (method, path regex, status, fixture or literal body, extra headers)
+# Fixture bodies are %-formatted with the named groups of the path regex
+# and the query parameters.
+ROUTES = [
+    ('GET',  r'^/watch$',                     200, 'watch.html', {}),
+    ('GET',  r'^/login$',                     200, 'login.html', {}),
+    ('POST', r'^/session$',                   200, 'landing.html', {}),
+    ('GET',  r'^/logout$',                    200, '', {}),
+    ('GET',  r'^/services/films/search\.json$', 200, 'search.json', {}),
+    ('GET',  r'^/services/films/tooltip$',    200, 'tooltip.json', {}),
+    ('GET',  r'^/users/\d+/watchlist\.json$', 200, 'watchlist.json', {}),
+    ('GET',  r'^/cinemas$',                   200, 'cinemas.html', {}),
+    ('GET',  r'^/programs/[\w-]+$',           200, 'program.html', {}),
+    ('GET',  r'^/cast_members/\d+$',          200, 'person.html', {}),
+    ('HEAD', r'^/films/(?P<id>\d+)/secure_url$', 200, '', {}),
+    ('GET',  r'^/films/(?P<id>\d+)/secure_url$', 200,
+             'http://stream.example.com/%(id)s.mp4', {}),
+    ('GET',  r'^/films/\d+/prescreen$',       200, 'prescreen.html', {}),
+    ('HEAD', r'^/films/(?P<id>\d+)$',         302, '',
+             {'Location': 'http://mubi.com/films/film-%(id)s'}),
+    ('GET',  r'^/films/[\w-]+/trailer$',      200, 'trailer.html', {}),
+    ('GET',  r'^/films/[\w-]+$',              200, 'film.html', {}),
+    ('HEAD', r'^/auteurs_production/images/', 200, '', {}),
+]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _respond(self, method):
+        split = urlsplit(self.path)
+        if method == 'POST':
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        for route_method, pattern, status, body, headers in ROUTES:
+            match = re.match(pattern, split.path)
+            if route_method != method or not match:
+                continue
+            params = dict((k, v[0]) for k, v in parse_qs(split.query).items())
+            params.update(match.groupdict())
+            if body.endswith(('.html', '.json')):
+                with io.open(os.path.join(FIXTURES, body),
+                             encoding='utf-8') as fp:
+                    body = fp.read()
+            if '%(' in body:
+                body = body % params
+            break
+        else:
+            status, body, headers = 404, 'Not Found', {}
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value % params if '%(' in value else value)
+        data = body.encode('utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if method != 'HEAD':
+            self.wfile.write(data)
+        self.server.record(len(data) if method != 'HEAD' else 0)
+
+    def do_GET(self):
+        self._respond('GET')
+
+    def do_HEAD(self):
+        self._respond('HEAD')
+
+    def do_POST(self):
+        self._respond('POST')
+
+    def log_message(self, *args):
+        pass
+
+
+class FixtureServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+        self._lock = threading.Lock()
+        self.reset()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.bytes_sent = 0
+
+    def record(self, size):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += size
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class ReplayAdapter(HTTPAdapter):
+    """ Transport adapter that sends requests for the real hosts to the
+    `FixtureServer` instead, keeping the original URLs on the responses.
+    """
+    def __init__(self, port):
+        super(ReplayAdapter, self).__init__()
+        self._netloc = '127.0.0.1:%d' % port
+
+    def send(self, request, **kwargs):
+        original_url = request.url
+        split = urlsplit(request.url)
+        request.url = urlunsplit(('http', self._netloc) + split[2:])
+        response = super(ReplayAdapter, self).send(request, **kwargs)
+        response.url = request.url = original_url
+        return response
+
+    def mount(self, session):
+        for prefix in ('http://mubi.com', 'https://mubi.com',
+                       'http://s3.amazonaws.com'):
+            session.mount(prefix, self)
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012, Johannes Baiter (jbaiter)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from resources.lib.records import Film, Person, Program, VideoMetadata
+
+
+class Catalog(object):
+    """ Local SQLite catalog of the films, persons and programs that were
+    retrieved from MUBI, with a full-text index over film titles, cast and
+    directors.
+
+    Listings (search results, filtered film pages, filmographies...) are
+    stored as ordered lists of ids under a key chosen by the caller, so
+    they can be served again without touching the network.
+    """
+    _SCHEMA_VERSION = 3
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS films (
+            mubi_id INTEGER PRIMARY KEY, title TEXT, filmstill TEXT,
+            updated REAL, added REAL);
+        CREATE TABLE IF NOT EXISTS metadata (
+            mubi_id INTEGER PRIMARY KEY, data TEXT, updated REAL);
+        CREATE TABLE IF NOT EXISTS persons (
+            mubi_id INTEGER PRIMARY KEY, name TEXT, portrait TEXT,
+            updated REAL);
+        CREATE TABLE IF NOT EXISTS programs (
+            identifier TEXT PRIMARY KEY, title TEXT, picture TEXT,
+            updated REAL);
+        CREATE TABLE IF NOT EXISTS listings (
+            key TEXT PRIMARY KEY, kind TEXT, num_pages INTEGER,
+            updated REAL);
+        CREATE TABLE IF NOT EXISTS listing_items (
+            key TEXT, position INTEGER, item_id TEXT, label TEXT,
+            PRIMARY KEY (key, position));
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    def __init__(self, path):
+        self._logger = logging.getLogger('mubi.Catalog')
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._create_schema()
+
+    def _create_schema(self):
+        with self._lock:
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version not in (0, self._SCHEMA_VERSION):
+                self._logger.debug("Catalog schema changed, rebuilding")
+                tables = [row[0] for row in self._conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table'"
+                    " AND name NOT LIKE 'films_fts_%'")]
+                for table in tables:
+                    self._conn.execute("DROP TABLE IF EXISTS %s" % table)
+            self._conn.executescript(self._SCHEMA)
+            try:
+                self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS "
+                                   "films_fts USING fts4(title, actors, "
+                                   "directors)")
+                self._has_fts = True
+            except sqlite3.OperationalError:
+                self._logger.debug("FTS4 not available, searching with LIKE")
+                self._has_fts = False
+            self._conn.execute("PRAGMA user_version = %d"
+                               % self._SCHEMA_VERSION)
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _index_film(self, mubi_id, title=None, cast=None, director=None):
+        if not self._has_fts:
+            return
+        row = self._conn.execute("SELECT title, actors, directors "
+                                 "FROM films_fts WHERE docid = ?",
+                                 (mubi_id,)).fetchone()
+        if row is not None:
+            title = title if title is not None else row[0]
+            cast = cast if cast is not None else row[1]
+            director = director if director is not None else row[2]
+            self._conn.execute("DELETE FROM films_fts WHERE docid = ?",
+                               (mubi_id,))
+        self._conn.execute("INSERT INTO films_fts (docid, title, actors, "
+                           "directors) VALUES (?, ?, ?, ?)",
+                           (mubi_id, title, cast, director))
+
+    def store_films(self, films):
+        now = time.time()
+        with self._lock:
+            for film in films:
+                self._conn.execute("INSERT OR REPLACE INTO films VALUES "
+                                   "(?, ?, ?, ?, COALESCE((SELECT added "
+                                   "FROM films WHERE mubi_id = ?), ?))",
+                                   (int(film.mubi_id), film.title,
+                                    film.still, now, int(film.mubi_id),
+                                    now))
+                self._index_film(int(film.mubi_id), title=film.title)
+            self._conn.commit()
+
+    def store_metadata(self, mubi_id, metadata, replace=True):
+        """ Store the metadata of a film. With `replace` set to False,
+        metadata that is already stored for the film is kept.
+        """
+        cast = metadata.cast
+        if isinstance(cast, (list, tuple)):
+            cast = u", ".join(cast)
+        with self._lock:
+            if not replace and self._conn.execute(
+                    "SELECT 1 FROM metadata WHERE mubi_id = ?",
+                    (int(mubi_id),)).fetchone() is not None:
+                return
+            self._conn.execute("INSERT OR REPLACE INTO metadata VALUES "
+                               "(?, ?, ?)",
+                               (int(mubi_id), json.dumps(metadata.pack()),
+                                time.time()))
+            self._index_film(int(mubi_id), cast=cast,
+                             director=metadata.director)
+            self._conn.commit()
+
+    def store_persons(self, persons):
+        now = time.time()
+        with self._lock:
+            for person in persons:
+                self._conn.execute("INSERT OR REPLACE INTO persons VALUES "
+                                   "(?, ?, ?, ?)",
+                                   (int(person.mubi_id), person.name,
+                                    person.packed_portrait, now))
+            self._conn.commit()
+
+    def store_programs(self, programs):
+        now = time.time()
+        with self._lock:
+            for program in programs:
+                self._conn.execute("INSERT OR REPLACE INTO programs VALUES "
+                                   "(?, ?, ?, ?)",
+                                   (program.identifier, program.title,
+                                    program.picture, now))
+            self._conn.commit()
+
+    def get_film(self, mubi_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM films WHERE mubi_id = ?",
+                                     (int(mubi_id),)).fetchone()
+        if row is None:
+            return None
+        return Film(row['title'], row['mubi_id'], row['filmstill'])
+
+    def get_metadata(self, mubi_id, max_age=None):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM metadata "
+                                     "WHERE mubi_id = ?",
+                                     (int(mubi_id),)).fetchone()
+        if row is None or (max_age is not None
+                           and time.time() - row['updated'] > max_age):
+            return None
+        return VideoMetadata.unpack(json.loads(row['data']))
+
+    def get_metadata_many(self, mubi_ids, max_age=None):
+        """ Return a dictionary of the stored metadata of `mubi_ids`,
+        keyed by (integer) film id. Films without metadata are left out.
+        """
+        mubi_ids = [int(x) for x in mubi_ids]
+        if not mubi_ids:
+            return {}
+        query = ("SELECT * FROM metadata WHERE mubi_id IN (%s)"
+                 % ", ".join("?" * len(mubi_ids)))
+        if max_age is not None:
+            query += " AND updated >= ?"
+            mubi_ids.append(time.time() - max_age)
+        with self._lock:
+            rows = self._conn.execute(query, mubi_ids).fetchall()
+        return dict((row['mubi_id'],
+                     VideoMetadata.unpack(json.loads(row['data'])))
+                    for row in rows)
+
+    def store_listing(self, key, kind, items, num_pages=1, labels=None):
+        """ Store `items` (Films, Persons or Programs, as given by `kind`)
+        and remember their order under `key`.
+
+        `labels` optionally gives each film a title that only applies to
+        this listing, the title stored with the film is left alone.
+        """
+        labels = labels or [None] * len(items)
+        store, get_id = {'film': (self.store_films, lambda x: x.mubi_id),
+                         'person': (self.store_persons, lambda x: x.mubi_id),
+                         'program': (self.store_programs,
+                                     lambda x: x.identifier)}[kind]
+        with self._lock:
+            store(items)
+            self._conn.execute("DELETE FROM listing_items WHERE key = ?",
+                               (key,))
+            self._conn.executemany("INSERT INTO listing_items VALUES "
+                                   "(?, ?, ?, ?)",
+                                   [(key, idx, unicode(get_id(x)), label)
+                                    for idx, (x, label)
+                                    in enumerate(zip(items, labels))])
+            self._conn.execute("INSERT OR REPLACE INTO listings VALUES "
+                               "(?, ?, ?, ?)",
+                               (key, kind, num_pages, time.time()))
+            self._conn.commit()
+
+    def get_listing(self, key, max_age=None):
+        """ Return a `(num_pages, items)` tuple for a stored listing, or
+        None if there is none or it is older than `max_age` seconds.
+        """
+        with self._lock:
+            listing = self._conn.execute("SELECT * FROM listings "
+                                         "WHERE key = ?", (key,)).fetchone()
+            if listing is None or (max_age is not None and
+                                   time.time() - listing['updated'] > max_age):
+                return None
+            query = {'film': "SELECT COALESCE(l.label, f.title), "
+                             "f.mubi_id, f.filmstill "
+                             "FROM films f JOIN listing_items l "
+                             "ON f.mubi_id = l.item_id",
+                     'person': "SELECT p.name, p.mubi_id, p.portrait "
+                               "FROM persons p JOIN listing_items l "
+                               "ON p.mubi_id = l.item_id",
+                     'program': "SELECT p.title, p.identifier, p.picture "
+                                "FROM programs p JOIN listing_items l "
+                                "ON p.identifier = l.item_id"
+                     }[listing['kind']]
+            rows = self._conn.execute(query + " WHERE l.key = ? "
+                                      "ORDER BY l.position", (key,)).fetchall()
+        record = {'film': Film, 'person': Person,
+                  'program': Program}[listing['kind']]
+        return listing['num_pages'], [record(*row) for row in rows]
+
+    def search_films(self, term, limit=100):
+        """ Full-text search over the titles, cast and directors of all
+        films in the catalog.
+        """
+        words = [x.replace('"', '') for x in term.split()]
+        with self._lock:
+            if self._has_fts:
+                query = u" ".join(u'"%s*"' % x for x in words if x)
+                rows = self._conn.execute(
+                    "SELECT f.title, f.mubi_id, f.filmstill FROM films f "
+                    "JOIN films_fts s ON f.mubi_id = s.docid "
+                    "WHERE films_fts MATCH ? LIMIT ?",
+                    (query, limit)).fetchall()
+            else:
+                rows = self._conn.execute(
+                    "SELECT title, mubi_id, filmstill FROM films "
+                    "WHERE title LIKE ? LIMIT ?",
+                    (u"%%%s%%" % term, limit)).fetchall()
+        return [Film(*row) for row in rows]
+
+    def known_film_ids(self, mubi_ids, added_before=None):
+        """ Return the subset of `mubi_ids` that is in the catalog,
+        optionally only those first stored before `added_before`.
+        """
+        mubi_ids = [int(x) for x in mubi_ids]
+        if not mubi_ids:
+            return set()
+        query = ("SELECT mubi_id FROM films WHERE mubi_id IN (%s)"
+                 % ", ".join("?" * len(mubi_ids)))
+        if added_before is not None:
+            query += " AND added < ?"
+            mubi_ids.append(added_before)
+        with self._lock:
+            return set(row[0] for row in self._conn.execute(query, mubi_ids))
+
+    def added_times(self, mubi_ids):
+        """ Return when each of `mubi_ids` was first stored, keyed by
+        (integer) film id.
+        """
+        mubi_ids = [int(x) for x in mubi_ids]
+        if not mubi_ids:
+            return {}
+        with self._lock:
+            return dict((row[0], row[1]) for row in self._conn.execute(
+                "SELECT mubi_id, added FROM films WHERE mubi_id IN (%s)"
+                % ", ".join("?" * len(mubi_ids)), mubi_ids))
+
+    def count_films(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM films"
+                                      ).fetchone()[0]
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?",
+                                     (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                               (key, json.dumps(value)))
+            self._conn.commit()
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012, Johannes Baiter (jbaiter)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import os
+
+from resources.lib.images import ImageCache
+from resources.lib.prefetch import Prefetcher
+from resources.lib.records import SORT_KEYS
+from resources.lib.remote import (MubiClient, MubiServer, RemotePrefetcher,
+                                  RemoteResolver, connect)
+from resources.lib.resolver import MetadataResolver
+from resources.lib.sync import CatalogSync
+from resources.lib.tracing import Tracer
+
+# The modules behind Mubi load requests, sqlite3 and the HTML parsers, they
+# are imported in create_mubi so that the plugin doesn't load them when the
+# resident service answers its calls.
+
+
+class Settings(object):
+    """ Typed access to the addon settings, which Kodi hands out as
+    strings. `get_setting` is the getter of either the plugin or the
+    addon object.
+    """
+    def __init__(self, get_setting):
+        self._get_setting = get_setting
+
+    def get(self, name, default=None):
+        return self._get_setting(name) or default
+
+    def get_int(self, name, default):
+        try:
+            return int(self._get_setting(name))
+        except (TypeError, ValueError):
+            return default
+
+    def get_float(self, name, default):
+        try:
+            return float(self._get_setting(name))
+        except (TypeError, ValueError):
+            return default
+
+    def get_bool(self, name):
+        return self._get_setting(name) == "true"
+
+
+def get_sort_key(settings):
+    """ Return the film sort key picked in the settings. """
+    keys = SORT_KEYS
+    index = settings.get_int("sort_key", 0)
+    return keys[index] if 0 <= index < len(keys) else keys[0]
+
+
+def create_tracer(settings, profile_path):
+    """ Return a Tracer, or None if tracing is disabled. """
+    if not settings.get_bool("tracing"):
+        return None
+    if not os.path.isdir(profile_path):
+        os.makedirs(profile_path)
+    return Tracer(os.path.join(profile_path, 'trace.log'))
+
+
+# The settings `create_mubi` reads, a Mubi instance that is kept around
+# has to be created again when one of them changes
+_MUBI_SETTINGS = ('username', 'password', 'taxonomy_ttl', 'max_workers',
+                  'country_code', 'availability_ttl', 'catalog_ttl',
+                  'sync_interval', 'http_cache_size', 'image_size', 'tracing',
+                  'metadata_ttl', 'http_timeout', 'http_retries', 'http_rate')
+
+
+def mubi_settings(settings):
+    """ Return the values of the settings a Mubi instance is created
+    from, to tell whether it is out of date.
+    """
+    return tuple(settings.get(x) for x in _MUBI_SETTINGS)
+
+
+def create_mubi(settings, profile_path, tracer=None):
+    """ Create a logged-in Mubi instance that keeps its state in
+    `profile_path`.
+    """
+    from resources.lib.catalog import Catalog
+    from resources.lib.httpcache import HTTPCache
+    from resources.lib.mubi import Mubi
+    if not os.path.isdir(profile_path):
+        os.makedirs(profile_path)
+    catalog = Catalog(os.path.join(profile_path, 'catalog.db'))
+    # Search the local catalog for up to two sync intervals, or for as
+    # long as listings are reused if it isn't updated in the background
+    local_search_ttl = (settings.get_int("sync_interval", 0) * 2
+                        or settings.get_int("catalog_ttl", 24)) * 60*60
+    http_cache = HTTPCache(os.path.join(profile_path, 'httpcache.db'),
+                           settings.get_int("http_cache_size", 50)
+                           * 1024*1024)
+    mubi = Mubi(profile_path=profile_path,
+                taxonomy_ttl=settings.get_int("taxonomy_ttl", 7) * 24*60*60,
+                max_workers=settings.get_int("max_workers", 8),
+                country_code=settings.get("country_code", 'US'),
+                availability_ttl=settings.get_int("availability_ttl", 24)
+                                 * 60*60,
+                catalog=catalog,
+                catalog_ttl=settings.get_int("catalog_ttl", 24) * 60*60,
+                http_cache=http_cache,
+                still_size=settings.get("image_size", 'w448'),
+                tracer=tracer,
+                metadata_ttl=settings.get_int("metadata_ttl", 7) * 24*60*60,
+                timeout=settings.get_int("http_timeout", 20),
+                retries=settings.get_int("http_retries", 2),
+                rate=settings.get_float("http_rate", 0),
+                local_search_ttl=local_search_ttl)
+    mubi.login(settings.get("username"), settings.get("password"))
+    return mubi
+
+
+def create_client(settings):
+    """ Return a MubiClient if the resident service is enabled and
+    running, None otherwise.
+    """
+    if not settings.get_bool("resident_service"):
+        return None
+    return connect(settings.get_int("service_port", 47811))
+
+
+def create_server(settings, mubi, images=None):
+    """ Return a MubiServer for `mubi` that runs read-ahead and metadata
+    resolution for its clients.
+    """
+    def prefetch(page, num_pages, **filters):
+        create_prefetcher(settings, mubi, images).start(page, num_pages,
+                                                        **filters)
+
+    def resolve_metadata(film_ids):
+        resolver = create_resolver(settings, mubi)
+        if resolver is not None:
+            resolver.start(film_ids)
+
+    return MubiServer(mubi, settings.get_int("service_port", 47811),
+                      prefetch=prefetch, resolve_metadata=resolve_metadata)
+
+
+def create_sync(settings, mubi):
+    return CatalogSync(mubi, mubi.catalog,
+                       max_workers=settings.get_int("sync_workers", 2),
+                       rate=settings.get_float("sync_rate", 1.0))
+
+
+def create_image_cache(settings, profile_path):
+    """ Return an ImageCache, or None if images shouldn't be cached. """
+    if not settings.get_bool("cache_images"):
+        return None
+    return ImageCache(os.path.join(profile_path, 'images'),
+                      max_size=settings.get_int("image_cache_size", 100)
+                               * 1024*1024,
+                      max_workers=settings.get_int("max_workers", 8),
+                      timeout=settings.get_int("http_timeout", 20))
+
+
+def create_prefetcher(settings, mubi, images=None):
+    if isinstance(mubi, MubiClient):
+        return RemotePrefetcher(mubi)
+    max_kb = settings.get_int("prefetch_max_kb", 2048)
+    return Prefetcher(mubi, depth=settings.get_int("prefetch_depth", 1),
+                      max_bytes=max_kb * 1024 if max_kb else None,
+                      images=(images if settings.get_bool("prefetch_images")
+                              else None),
+                      per_page=settings.get_int("films_per_page", 100))
+
+
+def create_resolver(settings, mubi):
+    """ Return a MetadataResolver, or None if film details shouldn't be
+    loaded in the background.
+    """
+    if not settings.get_bool("resolve_metadata"):
+        return None
+    if isinstance(mubi, MubiClient):
+        return RemoteResolver(mubi)
+    return MetadataResolver(mubi,
+                            max_workers=settings.get_int("sync_workers", 2),
+                            trailers=settings.get_bool("resolve_trailers"))
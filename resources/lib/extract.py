@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012, Johannes Baiter (jbaiter)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+""" Extractors turn the HTML pages served by MUBI into records.
+
+Every page is parsed exactly once. `LxmlExtractor` is used if lxml is
+installed, otherwise we fall back to the slower `BS3Extractor`.
+"""
+
+import re
+from math import ceil
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    from BeautifulSoup import BeautifulSoup as BS
+except ImportError:
+    BS = None
+
+from resources.lib.records import PAGE_SIZE, Film, Program
+
+
+class Extractor(object):
+    """ `still_size` is the size variant (w192, w320 or w448) that film
+    still URLs are rewritten to.
+    """
+    _regexps = {"item":        re.compile("item.*"),
+                "watch_link":  re.compile("watch_link.*"),
+                "duration":    re.compile(r"(\d+) Min"),
+                "program":     re.compile("use6.*"),
+                "rating":      re.compile(r"Currently ([1-5]\.\d)/5 Stars."),
+                "audio_lang":  re.compile(r"Audio in (.*)"),
+                "sub_lang":    re.compile(r"Subtitled in (.*)")}
+
+    def __init__(self, still_size='w448'):
+        self._still_size = still_size
+
+    def _num_pages(self, result_count):
+        return ceil(int(result_count.split()[0].replace(",", ""))
+                    / float(PAGE_SIZE))
+
+    def _credits(self, credits, role):
+        """ Return the names listed after the `role` label (CAST, DIR or
+        SCR) in a list of `(label, text)` tuples.
+        """
+        return [[name.strip() for name in text.replace(role, "").split(",")]
+                for label, text in credits if label == role][0]
+
+    def _languages(self, texts):
+        audio_language = subtitle_language = None
+        for text in texts:
+            audio = self._regexps["audio_lang"].match(text)
+            subtitle = self._regexps["sub_lang"].match(text)
+            if audio and audio_language is None:
+                audio_language = audio.group(1)
+            if subtitle and subtitle_language is None:
+                subtitle_language = subtitle.group(1)
+        return audio_language, subtitle_language
+
+    def _duration(self, texts):
+        for text in texts:
+            match = self._regexps["duration"].search(text)
+            if match:
+                return int(match.group(1))
+        return None
+
+
+class BS3Extractor(Extractor):
+    def _watchable_titles(self, page):
+        items = [x for x in page.findAll("div",
+                                         {"class": self._regexps["item"]})
+                 if (x.findChild("h2")
+                 and x.findChild("div",
+                                 {"class": self._regexps["watch_link"]}))]
+        return [Film(title=x.find("h2").text,
+                     mubi_id=x.get("data-item-id"),
+                     filmstill=(x.find("div", "cropped_image")
+                                .find("img").get("src")
+                                .replace("w192", self._still_size)))
+                for x in items]
+
+    def watchable_titles(self, html):
+        return self._watchable_titles(BS(html))
+
+    def listing(self, html):
+        """ Return the number of pages and the films on a listing page. """
+        page = BS(html)
+        num_pages = self._num_pages(page.find("strong", {"id": "result_count"})
+                                    .text)
+        return (num_pages, self._watchable_titles(page))
+
+    def _options(self, page, select_id):
+        options = page.find("select", {"id": select_id}).findAll("option")
+        return {x.text: x.get("value") for x in options
+                if x.get("value") != ""}
+
+    def taxonomy(self, html):
+        page = BS(html)
+        return {"genres": self._options(page, "category_id"),
+                "languages": self._options(page, "language_id"),
+                "countries": self._options(page, "historic_country_id")}
+
+    def programs(self, html):
+        programs = BS(html).findAll("div", {"class": self._regexps["program"]})
+        return [Program(title=x.find("h2").text,
+                        identifier=x.find("a").get("href").split("/")[-1],
+                        picture=x.find("img").get("src"))
+                for x in programs]
+
+    def program_films(self, html):
+        """ Return a `(Film, label)` pair for every film of a program, the
+        label adds the director, country and year to the title.
+        """
+        items = BS(html).findAll("div", {"class": self._regexps["item"]})
+        films = []
+        for x in items:
+            title = x.find("h2", "film_title ").text
+            films.append((Film(title=title,
+                               mubi_id=x.get("data-item-id"),
+                               filmstill=x.find("img").get("src").replace(
+                                   "w320", self._still_size)),
+                          "%s: %s (%s)" % (
+                              x.find("h2", "film_director").find("a").text,
+                              title,
+                              x.find("h3", "film_country_year").text)))
+        return films
+
+    def auth_token(self, html):
+        return (BS(html).find("input", {"name": "authenticity_token"})
+                .get("value"))
+
+    def user_id(self, html):
+        return BS(html).find("a", "user_avatar").get("href").split("/")[-1]
+
+    def availability(self, html):
+        status = BS(html).find("div", "film_viewable_status ").text
+        return not "Not Available to watch" in status
+
+    def trailer(self, html):
+        return BS(html).find("div", "flashplayer").get("data-video_url")
+
+    def metadata(self, html):
+        """ Return the fields of a film page as a dict. The trailer is on
+        a separate page, its URL is returned as 'trailer_page'.
+        """
+        page = BS(html)
+        credits = [(x.span.text, x.text)
+                   for x in page.findAll("h3", "film_cast")]
+        try: originaltitle = page.find("h2", "film_title notbold blue").text
+        except AttributeError: originaltitle = None
+        try: playcount = int(page.find("div", "film_views").span.text
+                             .replace(",", ""))
+        except AttributeError: playcount = None
+        try: trailer_page = page.find("a", "watch_trailer").get("href")
+        except AttributeError: trailer_page = None
+        audio_language, subtitle_language = self._languages(
+            [x.text for x in page.findAll("div", "film_subtitle_language")])
+        return {'year': page.find("h3", "film_year").text,
+                'rating': float(self._regexps["rating"].match(
+                                page.find("li", "current_rating").text)
+                                .group(1)),
+                'cast': self._credits(credits, "CAST"),
+                'director': ", ".join(self._credits(credits, "DIR")),
+                'writer': ", ".join(self._credits(credits, "SCR")),
+                'plot': "\n".join([x.text for x in
+                                   page.find("div", "content greenbg clear")
+                                   .findAll("p")]),
+                'title': page.find("h1", "film_title blue").text,
+                'originaltitle': originaltitle,
+                'duration': self._duration([text for x in page.findAll("div")
+                                            for text in x.findAll(
+                                                text=True, recursive=False)]),
+                'playcount': playcount,
+                'audio_language': audio_language,
+                'subtitle_language': subtitle_language,
+                'trailer_page': trailer_page}
+
+
+def _has_class(classes):
+    """ Return an XPath predicate for elements that carry all of the
+    space-separated `classes`, whatever other classes they have.
+    """
+    return " and ".join("contains(concat(' ', normalize-space(@class), ' '),"
+                        " ' %s ')" % x for x in classes.split())
+
+
+class LxmlExtractor(Extractor):
+    """ Extracts the same data as `BS3Extractor` with XPath queries on an
+    lxml tree, which is an order of magnitude faster to build. Class
+    selectors match elements that carry the class among others, as
+    BeautifulSoup does.
+    """
+    def _parse(self, html):
+        # lxml refuses empty documents, for which BeautifulSoup gives an
+        # empty tree
+        if not html or not html.strip():
+            return lxml.html.Element('html')
+        return lxml.html.fromstring(html)
+
+    def _first(self, element, xpath):
+        result = element.xpath(xpath)
+        return result[0] if result else None
+
+    def _text(self, element, xpath):
+        result = self._first(element, xpath)
+        return result.text_content().strip() if result is not None else None
+
+    def _still(self, element, xpath, size):
+        still = self._first(element, xpath)
+        return still.replace(size, self._still_size) if still else still
+
+    def _watchable_titles(self, page):
+        items = page.xpath('//div[contains(@class, "item")]'
+                           '[.//h2][.//div[contains(@class, "watch_link")]]')
+        return [Film(title=self._text(x, './/h2'),
+                     mubi_id=x.get("data-item-id"),
+                     filmstill=self._still(
+                         x, './/div[%s]//img/@src'
+                            % _has_class("cropped_image"), "w192"))
+                for x in items]
+
+    def watchable_titles(self, html):
+        return self._watchable_titles(self._parse(html))
+
+    def listing(self, html):
+        page = self._parse(html)
+        result_count = self._text(page, '//strong[@id="result_count"]')
+        num_pages = self._num_pages(result_count) if result_count else 0
+        return (num_pages, self._watchable_titles(page))
+
+    def _options(self, page, select_id):
+        options = page.xpath('//select[@id="%s"]/option' % select_id)
+        return {x.text_content().strip(): x.get("value") for x in options
+                if x.get("value")}
+
+    def taxonomy(self, html):
+        page = self._parse(html)
+        return {"genres": self._options(page, "category_id"),
+                "languages": self._options(page, "language_id"),
+                "countries": self._options(page, "historic_country_id")}
+
+    def programs(self, html):
+        programs = self._parse(html).xpath('//div[contains(@class, "use6")]')
+        return [Program(title=self._text(x, './/h2'),
+                        identifier=self._first(x, './/a/@href')
+                                   .split("/")[-1],
+                        picture=self._first(x, './/img/@src'))
+                for x in programs]
+
+    def program_films(self, html):
+        items = self._parse(html).xpath('//div[contains(@class, "item")]')
+        films = []
+        for x in items:
+            title = self._text(x, './/h2[%s]' % _has_class("film_title"))
+            films.append((Film(title=title,
+                               mubi_id=x.get("data-item-id"),
+                               filmstill=self._still(x, './/img/@src',
+                                                     "w320")),
+                          "%s: %s (%s)" % (
+                              self._text(x, './/h2[%s]//a'
+                                            % _has_class("film_director")),
+                              title,
+                              self._text(x, './/h3[%s]' % _has_class(
+                                  "film_country_year")))))
+        return films
+
+    def auth_token(self, html):
+        return self._first(self._parse(html),
+                           '//input[@name="authenticity_token"]/@value')
+
+    def user_id(self, html):
+        href = self._first(self._parse(html),
+                           '//a[%s]/@href' % _has_class("user_avatar"))
+        return href.split("/")[-1] if href else None
+
+    def availability(self, html):
+        status = self._text(self._parse(html), '//div[%s]' % _has_class(
+            "film_viewable_status"))
+        return status is not None and "Not Available to watch" not in status
+
+    def trailer(self, html):
+        return self._first(self._parse(html), '//div[%s]/@data-video_url'
+                                              % _has_class("flashplayer"))
+
+    def metadata(self, html):
+        page = self._parse(html)
+        credits = [(self._text(x, './/span'), x.text_content().strip())
+                   for x in page.xpath('//h3[%s]' % _has_class("film_cast"))]
+        playcount = self._text(page, '//div[%s]//span'
+                                     % _has_class("film_views"))
+        rating = self._text(page, '//li[%s]' % _has_class("current_rating"))
+        rating = rating and self._regexps["rating"].match(rating)
+        audio_language, subtitle_language = self._languages(
+            [x.text_content().strip() for x in page.xpath(
+                '//div[%s]' % _has_class("film_subtitle_language"))])
+        return {'year': self._text(page, '//h3[%s]' % _has_class("film_year")),
+                'rating': float(rating.group(1)) if rating else None,
+                'cast': self._credits(credits, "CAST"),
+                'director': ", ".join(self._credits(credits, "DIR")),
+                'writer': ", ".join(self._credits(credits, "SCR")),
+                'plot': "\n".join(x.text_content().strip() for x in page.xpath(
+                    '//div[%s]//p' % _has_class("content greenbg clear"))),
+                'title': self._text(page, '//h1[%s]'
+                                          % _has_class("film_title blue")),
+                'originaltitle': self._text(
+                    page, '//h2[%s]' % _has_class("film_title notbold blue")),
+                'duration': self._duration(page.xpath('//div/text()')),
+                'playcount': (int(playcount.replace(",", ""))
+                              if playcount is not None else None),
+                'audio_language': audio_language,
+                'subtitle_language': subtitle_language,
+                'trailer_page': self._first(
+                    page, '//a[%s]/@href' % _has_class("watch_trailer"))}
+
+
+def get_extractor(still_size='w448'):
+    """ Return the fastest extractor that is available. """
+    if lxml is not None:
+        return LxmlExtractor(still_size)
+    return BS3Extractor(still_size)
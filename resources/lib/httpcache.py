@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012, Johannes Baiter (jbaiter)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import json
+import logging
+import random
+import re
+import sqlite3
+import threading
+import time
+from urllib import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+class HTTPCache(object):
+    """ Size-bounded on-disk store for HTTP responses.
+
+    Responses are kept in a SQLite database together with their validators
+    (ETag and Last-Modified), the least recently used ones are evicted
+    once the total size of the stored bodies exceeds `max_size` bytes.
+    The database is shared between processes, errors accessing it make
+    lookups miss and stores fail silently.
+    """
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, url TEXT, headers TEXT, body BLOB,
+            size INTEGER, stored REAL, accessed REAL);
+        CREATE INDEX IF NOT EXISTS responses_accessed
+            ON responses (accessed);
+    """
+
+    def __init__(self, path, max_size=50*1024*1024):
+        self._logger = logging.getLogger('mubi.HTTPCache')
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(self._SCHEMA)
+        self._max_size = max_size
+        self._accessed = {}
+
+    def get(self, key):
+        """ Return a `(response, age)` tuple for `key`, or None. """
+        try:
+            with self._lock:
+                row = self._conn.execute("SELECT url, headers, body, stored "
+                                         "FROM responses WHERE key = ?",
+                                         (key,)).fetchone()
+                if row is None:
+                    return None
+                # Access times are written with the next stored response,
+                # so that cache hits don't have to write to the database
+                self._accessed[key] = time.time()
+        except sqlite3.Error as e:
+            self._logger.debug("Could not read from the HTTP cache: %s" % e)
+            return None
+        url, headers, body, stored = row
+        response = requests.models.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.url = url
+        response.headers = CaseInsensitiveDict(json.loads(headers))
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers)
+        response._content = bytes(body)
+        response.from_cache = True
+        return response, time.time() - stored
+
+    def set(self, key, response):
+        body = response.content
+        now = time.time()
+        try:
+            with self._lock:
+                self._conn.executemany("UPDATE responses SET accessed = ? "
+                                       "WHERE key = ?",
+                                       [(accessed, accessed_key)
+                                        for accessed_key, accessed
+                                        in self._accessed.items()])
+                self._accessed = {}
+                self._conn.execute("INSERT OR REPLACE INTO responses VALUES "
+                                   "(?, ?, ?, ?, ?, ?, ?)",
+                                   (key, response.url,
+                                    json.dumps(dict(response.headers)),
+                                    sqlite3.Binary(body), len(body), now,
+                                    now))
+                self._evict()
+                self._conn.commit()
+        except sqlite3.Error as e:
+            self._logger.debug("Could not write to the HTTP cache: %s" % e)
+            self._rollback()
+
+    def touch(self, key):
+        """ Mark a stored response as fresh again, after revalidation. """
+        try:
+            with self._lock:
+                self._conn.execute("UPDATE responses SET stored = ? "
+                                   "WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+        except sqlite3.Error as e:
+            self._logger.debug("Could not write to the HTTP cache: %s" % e)
+            self._rollback()
+
+    def _rollback(self):
+        try:
+            with self._lock:
+                self._conn.rollback()
+        except sqlite3.Error:
+            pass
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) "
+                                   "FROM responses").fetchone()[0]
+        if total <= self._max_size:
+            return
+        # Evict down to 90% so we don't have to do this on every store
+        target = total - int(self._max_size * 0.9)
+        freed = 0
+        for key, size in self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY accessed"
+                ).fetchall():
+            if freed >= target:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            freed += size
+        self._logger.debug("Evicted %d bytes from the HTTP cache" % freed)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+
+class CachingSession(requests.Session):
+    """ requests session that serves GET requests from an `HTTPCache`.
+
+    `rules` is a list of `(url_class, regex, ttl)` tuples, the first rule
+    whose pattern matches a URL determines its class and its TTL in seconds.
+    URLs that match no rule, or a rule with a TTL of 0, are never cached.
+    Stale responses are revalidated with a conditional request if the server
+    sent validators. If a `Tracer` is given, every request is recorded with
+    the class of its URL.
+
+    Requests that go to the network time out after `timeout` seconds and
+    pass through `limiter`, if given. GET and HEAD requests are retried up
+    to `retries` times after connection errors, timeouts and throttling or
+    server errors, waiting a random fraction of an exponentially growing
+    delay in between. Up to `pool_size` connections per host are kept
+    alive.
+    """
+    _IDEMPOTENT = ('GET', 'HEAD')
+    _RETRY_STATUS = (429, 500, 502, 503, 504)
+    _THROTTLE_STATUS = (429, 503)
+    # Seconds we are willing to wait for a server that asks us to retry
+    _MAX_DELAY = 30
+
+    def __init__(self, cache=None, rules=(), tracer=None, timeout=None,
+                 retries=0, backoff=0.5, limiter=None, pool_size=10):
+        super(CachingSession, self).__init__()
+        self._logger = logging.getLogger('mubi.CachingSession')
+        self._cache = cache
+        self._rules = [(url_class, re.compile(pattern), ttl)
+                       for url_class, pattern, ttl in rules]
+        self._tracer = tracer
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._limiter = limiter
+        for prefix in ('http://', 'https://'):
+            self.mount(prefix, HTTPAdapter(pool_connections=pool_size,
+                                           pool_maxsize=pool_size))
+        # Body bytes downloaded from the network, i.e. not from the cache,
+        # in total and by URL class
+        self.bytes_received = 0
+        self.bytes_by_class = {}
+
+    def _delay(self, attempt, response=None):
+        retry_after = (response.headers.get('retry-after')
+                       if response is not None else None)
+        try:
+            return min(float(retry_after), self._MAX_DELAY)
+        except (TypeError, ValueError):
+            return random.uniform(0, self._backoff * 2 ** attempt)
+
+    def _send(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self._timeout
+        attempts = 1
+        if method.upper() in self._IDEMPOTENT:
+            attempts += self._retries
+        for attempt in range(attempts):
+            if self._limiter is not None:
+                self._limiter.acquire()
+            try:
+                response = super(CachingSession, self).request(method, url,
+                                                               **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == attempts - 1:
+                    raise
+                self._logger.debug("Retrying %s %s after: %s"
+                                   % (method, url, e))
+                time.sleep(self._delay(attempt))
+                continue
+            if self._limiter is not None:
+                if response.status_code in self._THROTTLE_STATUS:
+                    self._limiter.throttle()
+                else:
+                    self._limiter.relax()
+            if (response.status_code not in self._RETRY_STATUS
+                    or attempt == attempts - 1):
+                break
+            self._logger.debug("Retrying %s %s after status %d"
+                               % (method, url, response.status_code))
+            time.sleep(self._delay(attempt, response))
+        if not kwargs.get('stream'):
+            received = len(response.content or b'')
+            url_class = self.classify(url)[0]
+            self.bytes_received += received
+            self.bytes_by_class[url_class] = (
+                self.bytes_by_class.get(url_class, 0) + received)
+        return response
+
+    def classify(self, url):
+        """ Return the class and the cache TTL of `url`. """
+        for url_class, pattern, ttl in self._rules:
+            if pattern.search(url):
+                return url_class, ttl
+        return "other", 0
+
+    def request(self, method, url, cache=True, **kwargs):
+        """ Send a request, with `cache` False it goes past the cache
+        and its response isn't stored.
+        """
+        url_class, ttl = self.classify(url)
+        start = time.time()
+        response = self._cached_request(method, url, ttl if cache else 0,
+                                        **kwargs)
+        if self._tracer is not None:
+            self._tracer.record_request(url_class, method, response,
+                                        time.time() - start)
+        return response
+
+    def _cached_request(self, method, url, ttl, **kwargs):
+        if (self._cache is None or method.upper() != 'GET'
+                or kwargs.get('stream') or not ttl):
+            return self._send(method, url, **kwargs)
+        key = url
+        if kwargs.get('params'):
+            key += "?" + urlencode(sorted(kwargs['params'].items()))
+        cached = self._cache.get(key)
+        if cached is not None:
+            response, age = cached
+            if age < ttl:
+                return response
+            headers = dict(kwargs.get('headers') or {})
+            if response.headers.get('etag'):
+                headers['If-None-Match'] = response.headers['etag']
+            if response.headers.get('last-modified'):
+                headers['If-Modified-Since'] = response.headers[
+                    'last-modified']
+            kwargs['headers'] = headers
+        fresh = self._send(method, url, **kwargs)
+        if cached is not None and fresh.status_code == 304:
+            self._cache.touch(key)
+            return cached[0]
+        # Don't store responses that ended up somewhere we wouldn't cache,
+        # e.g. the login page after the session expired.
+        if fresh.status_code == 200 and self.classify(fresh.url)[1]:
+            self._cache.set(key, fresh)
+        return fresh
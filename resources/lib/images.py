@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012, Johannes Baiter (jbaiter)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import hashlib
+import logging
+import os
+import threading
+
+from resources.lib.pool import parallel_map
+
+
+class ImageCache(object):
+    """ Directory of downloaded film stills, portraits and program pictures
+    that is kept below `max_size` bytes by removing the least recently used
+    files.
+
+    Kodi is handed the local path of an image once it has been downloaded;
+    until then it gets the original URL while the download happens in the
+    background. Downloads give up after `timeout` seconds without data.
+    """
+    def __init__(self, path, max_size=100*1024*1024, max_workers=8,
+                 session=None, timeout=20):
+        self._logger = logging.getLogger('mubi.ImageCache')
+        self._path = path
+        self._max_size = max_size
+        self._max_workers = max_workers
+        self._session = session
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self.bytes_received = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, url):
+        extension = os.path.splitext(url.split("?")[0])[1] or ".jpg"
+        return os.path.join(self._path,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest()
+                            + extension)
+
+    def local_path(self, url):
+        """ Return the local path of `url` if it was downloaded. """
+        path = self._file(url)
+        if not os.path.exists(path):
+            return None
+        try:
+            # The modification time is our LRU clock
+            os.utime(path, None)
+        except OSError:
+            pass
+        return path
+
+    def fetch(self, url):
+        """ Download `url` unless it is cached and return its local path,
+        or the URL itself if the download failed.
+        """
+        if not url:
+            return url
+        path = self.local_path(url)
+        if path is not None:
+            return path
+        # requests is only loaded once something has to be downloaded, the
+        # plugin mostly looks up local paths
+        import requests
+        with self._lock:
+            if self._session is None:
+                self._session = requests.session()
+        try:
+            response = self._session.get(url, timeout=self._timeout)
+        except requests.RequestException as e:
+            self._logger.debug("Could not download '%s': %s" % (url, e))
+            return url
+        if not response:
+            return url
+        path = self._file(url)
+        tmp_path = "%s.%s.tmp" % (path, threading.current_thread().ident)
+        with open(tmp_path, 'wb') as fp:
+            fp.write(response.content)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another thread has downloaded the same image
+            os.remove(tmp_path)
+        with self._lock:
+            self.bytes_received += len(response.content)
+        return path
+
+    def fetch_all(self, urls):
+        paths = parallel_map(self.fetch, urls, self._max_workers)
+        self.evict()
+        return paths
+
+    def prefetch(self, urls):
+        """ Download `urls` in a background thread. """
+        missing = [x for x in set(urls) if x and self.local_path(x) is None]
+        if not missing:
+            return None
+        thread = threading.Thread(target=self.fetch_all, args=(missing,))
+        thread.start()
+        return thread
+
+    def resolve(self, urls):
+        """ Return the local path for every image in `urls` that is cached
+        and the original URL for the others, which are then downloaded in
+        the background for next time.
+        """
+        paths = [self.local_path(x) if x else None for x in urls]
+        self.prefetch([url for url, path in zip(urls, paths) if not path])
+        return [path or url for url, path in zip(urls, paths)]
+
+    def evict(self):
+        files = []
+        for name in os.listdir(self._path):
+            path = os.path.join(self._path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self._max_size:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
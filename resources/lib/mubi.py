@@ -26,36 +26,30 @@
 
 import json
 import logging
+import os
 import re
-from collections import namedtuple
-from math import ceil
+import threading
+import time
 from urllib import urlencode
-from urlparse import urljoin
+from urlparse import parse_qs, urljoin, urlsplit
 
-import requests
-from BeautifulSoup import BeautifulSoup as BS
-
-Film = namedtuple('Film', ['title', 'mubi_id', 'filmstill'])
-Person = namedtuple('Person', ['name', 'mubi_id', 'portrait'])
-Program = namedtuple('Program', ['title', 'identifier', 'picture'])
-VideoMetadata = namedtuple('VideoMetadata',
-                           ['year', 'rating', 'cast', 'director', 'plot',
-                            'title', 'originaltitle', 'duration', 'writer',
-                            'playcount', 'trailer', 'audio_language',
-                            'subtitle_language', 'plotoutline'])
+from resources.lib.extract import get_extractor
+from resources.lib.httpcache import CachingSession
+from resources.lib.pool import (AdaptiveRateLimiter, parallel_imap,
+                                parallel_map)
+from resources.lib.records import (FILMSTILL_URL, PAGE_SIZE, PORTRAIT_URL,
+                                   SORT_KEYS, Film, Person, VideoMetadata,
+                                   pack_url, unpack_url)
+from resources.lib.storage import JSONStore
+from resources.lib.tracing import TracingExtractor
 
 
 class Mubi(object):
     _URL_MUBI = "http://mubi.com"
     _URL_MUBI_SECURE = "https://mubi.com"
-    _regexps = {"item":        re.compile("item.*"),
-                "watch_link":  re.compile("watch_link.*"),
-                "duration":    re.compile("\d+ Min"),
-                "program":     re.compile("use6.*"),
-                "rating":      re.compile(r"Currently ([1-5]\.\d)/5 Stars."),
-                "audio_lang":  re.compile(r"Audio in (.*)"),
-                "sub_lang":    re.compile(r"Subtitled in (.*)"),
-                "watch_page":  re.compile(r"^.*/watch$")}
+    _regexps = {"watch_page":  re.compile(r"^.*/watch$"),
+                "login_page":  re.compile(r"^https?://mubi.com/login"),
+                "filmstill":   re.compile(r"/images/film/([^/]+)/")}
     _mubi_urls = {
                   "login":      urljoin(_URL_MUBI_SECURE, "login"),
                   "session":    urljoin(_URL_MUBI_SECURE, "session"),
@@ -68,54 +62,180 @@ class Mubi(object):
                   "list":       urljoin(_URL_MUBI, "watch"),
                   "person":     urljoin(_URL_MUBI, "cast_members/%s"),
                   "logout":     urljoin(_URL_MUBI, "logout"),
-                  "filmstill":  "http://s3.amazonaws.com/auteurs_production/images/film/%s/w448/%s.jpg",
+                  "filmstill":  FILMSTILL_URL,
                   "shortdetails": urljoin(_URL_MUBI,
-                                          "/services/films/tooltip?id=%s&country_code=US&locale=en_US"),
+                                          "/services/films/tooltip?id=%s&country_code=%s&locale=en_US"),
                   "fulldetails": urljoin(_URL_MUBI, "films/%s"),
                   "watchlist":  urljoin(_URL_MUBI, "/users/%s/watchlist.json"),
-                  "portrait":   "http://s3.amazonaws.com/auteurs_production/images/cast_member/%s/original.jpg"
+                  "portrait":   PORTRAIT_URL
                  }
 
-    _SORT_KEYS = ['popularity', 'recently_added', 'rating', 'year', 'running_time']
+    _SORT_KEYS = SORT_KEYS
     _USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_5_8) AppleWebKit/535.19 (KHTML, like Gecko) Chrome/18.0.1025.151 Safari/535.19"
 
-    def __init__(self):
+    _TAXONOMY_VERSION = 1
+
+    # URL classes and the seconds their responses are served from the HTTP
+    # cache, the first matching pattern wins
+    _URL_CLASSES = [("auth", r"/(login|session|logout)$", 0),
+                    ("video", r"/secure_url$|/prescreen$", 0),
+                    ("image", r"amazonaws\.com/", 0),
+                    ("taxonomy", r"/watch$", 7*24*60*60),
+                    ("listing", r"/watch\?", 10*60),
+                    ("watchlist", r"/watchlist\.json$", 60),
+                    ("search", r"/services/films/search\.json", 60*60),
+                    ("tooltip", r"/services/films/tooltip", 24*60*60),
+                    ("program", r"/(cinemas|programs)", 60*60),
+                    ("person", r"/cast_members/", 24*60*60),
+                    ("film", r"/films/", 24*60*60)]
+
+    def __init__(self, profile_path=None, taxonomy_ttl=7*24*60*60,
+                 max_workers=8, country_code='US', availability_ttl=24*60*60,
+                 catalog=None, catalog_ttl=24*60*60, extractor=None,
+                 http_cache=None, still_size='w448', tracer=None,
+                 metadata_ttl=7*24*60*60, stream_ttl=10*60, timeout=20,
+                 retries=2, rate=0, local_search_ttl=48*60*60):
         self._logger = logging.getLogger('mubi.Mubi')
-        self._session = requests.session()
+        self._session = CachingSession(
+            http_cache, self._URL_CLASSES, tracer, timeout=timeout,
+            retries=retries,
+            limiter=AdaptiveRateLimiter(rate, burst=max_workers),
+            pool_size=max_workers)
         self._session.headers = {'User-Agent': self._USER_AGENT}
-        list_page = BS(self._session.get(self._mubi_urls["list"]).content)
-        self.genres = self._parse_genres(list_page)
-        self.languages = self._parse_languages(list_page)
-        self.countries = self._parse_countries(list_page)
+        self._profile_path = profile_path
+        self._session_store = JSONStore(self._profile_file("session.json"))
+        self._taxonomy_store = JSONStore(self._profile_file("taxonomy.json"),
+                                         version=self._TAXONOMY_VERSION)
+        self._taxonomy_ttl = taxonomy_ttl
+        self._taxonomy = None
+        self._taxonomy_lock = threading.Lock()
+        self._taxonomy_refreshing = False
+        self._auth_lock = threading.RLock()
+        self._auth_generation = 0
+        self._saved_cookies = None
+        self._max_workers = max_workers
+        self._country_code = country_code
+        self._availability_store = JSONStore(
+            self._profile_file("availability.json"))
+        self._availability_ttl = availability_ttl
+        self._stream_store = JSONStore(self._profile_file("streams.json"))
+        self._stream_ttl = stream_ttl
+        self._catalog = catalog
+        self._catalog_ttl = catalog_ttl
+        self._local_search_ttl = local_search_ttl
+        self._metadata_ttl = metadata_ttl
+        self._still_size = still_size
+        self._extractor = extractor or get_extractor(still_size)
+        if tracer is not None:
+            self._extractor = TracingExtractor(self._extractor, tracer)
+        self._portrait_store = JSONStore(self._profile_file("portraits.json"))
+        # With a catalog, the slugs of films are those of the stills that
+        # are stored with them, slugs.json is only kept without one
+        self._slug_store = JSONStore(None if catalog
+                                     else self._profile_file("slugs.json"))
 
-    def __del__(self):
-        self._session.get(self._mubi_urls["logout"])
+    @property
+    def genres(self):
+        return self._get_taxonomy()["genres"]
+
+    @property
+    def languages(self):
+        return self._get_taxonomy()["languages"]
+
+    @property
+    def countries(self):
+        return self._get_taxonomy()["countries"]
+
+    @property
+    def catalog(self):
+        return self._catalog
+
+    @property
+    def bytes_received(self):
+        return self._session.bytes_received
+
+    def bytes_received_for(self, url_class):
+        """ Return the bytes downloaded for URLs of one of the classes in
+        `_URL_CLASSES`.
+        """
+        return self._session.bytes_by_class.get(url_class, 0)
+
+    def _profile_file(self, name):
+        if not self._profile_path:
+            return None
+        return os.path.join(self._profile_path, name)
+
+    def _cached_listing(self, key):
+        if not self._catalog:
+            return None
+        return self._catalog.get_listing(key, max_age=self._catalog_ttl)
+
+    def _store_listing(self, key, kind, items, num_pages=1, labels=None):
+        if kind == 'film':
+            self._remember_slugs(items)
+        if self._catalog:
+            self._catalog.store_listing(key, kind, items, int(num_pages),
+                                        labels)
+
+    def _slug_from_still(self, filmstill):
+        match = filmstill and self._regexps["filmstill"].search(filmstill)
+        return match.group(1) if match else None
+
+    def _set_slug(self, mubi_id, slug):
+        if (not self._catalog
+                and self._slug_store.get(unicode(mubi_id)) != slug):
+            self._slug_store.set(unicode(mubi_id), slug)
+
+    def _remember_slugs(self, films):
+        if self._catalog:
+            return
+        for film in films:
+            slug = self._slug_from_still(film.filmstill)
+            if slug:
+                self._set_slug(film.mubi_id, slug)
+
+    def _is_login_redirect(self, response):
+        location = response.headers.get('location') or ''
+        return bool(self._regexps["login_page"].match(response.url or '')
+                    or self._regexps["login_page"].match(location))
 
-    def _parse_watchable_titles(self, page):
-        items = [x for x in BS(page).findAll("div",
-                                             {"class": self._regexps["item"]})
-                 if (x.findChild("h2")
-                 and x.findChild("div",
-                                 {"class": self._regexps["watch_link"]}))]
-        return [Film(title=x.find("h2").text,
-                     mubi_id=x.get("data-item-id"),
-                     filmstill=(x.find("div", "cropped_image")
-                                .find("img").get("src")
-                                .replace("w192", "w448")))
-                for x in items]
+    def _request(self, method, url, **kwargs):
+        """ Send a request, logging in again if the session has expired. """
+        generation = self._auth_generation
+        response = getattr(self._session, method)(url, **kwargs)
+        if (self._is_login_redirect(response)
+                and getattr(self, '_username', None)):
+            # Concurrent requests that hit the expired session log in only
+            # once, the others wait and retry with the new session.
+            with self._auth_lock:
+                if generation == self._auth_generation:
+                    self._logger.debug("Session expired, logging in again")
+                    self._session_store.delete("session")
+                    self._authenticate()
+            response = getattr(self._session, method)(url, **kwargs)
+        elif (self._saved_cookies is not None
+              and self._cookie_state() != self._saved_cookies):
+            # The server rotated the session cookies
+            self._save_session()
+        return response
+
+    def _get(self, url, **kwargs):
+        return self._request('get', url, **kwargs)
+
+    def _head(self, url, **kwargs):
+        return self._request('head', url, **kwargs)
 
     def _search(self, term):
-        return json.loads(self._session.get(self._mubi_urls["search"] % term)
-                          .content)
+        return json.loads(self._get(self._mubi_urls["search"] % term).content)
 
     def _get_shortdetails(self, mubi_id):
         # Available keys: cast, directors, duration [minutes], excerpt,
         #                 id, primary_country, title, year
-        info = json.loads(self._session.get(self._mubi_urls["shortdetails"]
-                                            % unicode(mubi_id)
+        info = json.loads(self._get(self._mubi_urls["shortdetails"]
+                                    % (unicode(mubi_id), self._country_code)
                          ).content)
         return (Film(info['title'], info['id'],
-                     self._get_filmstill(self._resolve_id(info['id']))),
+                     self._get_filmstill(self._get_slug(info['id']))),
                 VideoMetadata(year=info['year'], rating=None,
                               cast=info['cast'].split(", "),
                               director=", ".join(info['directors'].values()),
@@ -127,90 +247,188 @@ class Mubi(object):
                )
 
     def _get_filmstill(self, name):
-        return self._mubi_urls["filmstill"] % (name, name)
+        return self._mubi_urls["filmstill"] % (name, self._still_size, name)
 
     def _get_person_image(self, person_id):
-        url = self._mubi_urls["portrait"] % unicode(person_id)
-        if not self._session.head(url):
-            url = url.replace("jpg", "jpeg")
+        # Portraits are either .jpg or .jpeg, which we only find out by
+        # asking, so we remember the answer.
+        url = unpack_url(self._portrait_store.get(unicode(person_id)))
+        if url is None:
+            url = self._mubi_urls["portrait"] % (unicode(person_id), "jpg")
+            if not self._session.head(url):
+                url = self._mubi_urls["portrait"] % (unicode(person_id),
+                                                     "jpeg")
+            self._portrait_store.set(unicode(person_id), pack_url(url))
         return url
 
+    def _get_slug(self, mubi_id):
+        # The slug names the film in URLs, we only ask MUBI for it if no
+        # listing, search or catalog entry has told us already
+        if self._catalog:
+            film = self._catalog.get_film(mubi_id)
+            slug = film and self._slug_from_still(film.filmstill)
+        else:
+            slug = self._slug_store.get(unicode(mubi_id))
+        if slug is None:
+            slug = self._resolve_id(mubi_id)
+            self._set_slug(mubi_id, slug)
+        return slug
+
     def _resolve_id(self, mubi_id):
-        return self._session.head(self._mubi_urls["fulldetails"] % mubi_id
-                ).headers['location'].split("/")[-1]
-
-    def _parse_genres(self, list_page):
-        options = (list_page.find("select", {"id": "category_id"})
-                   .findAll("option"))
-        return {x.text: x.get("value") for x in options
-                if x.get("value") != ""}
-
-    def _parse_languages(self, list_page):
-        options = (list_page.find("select", {"id": "language_id"})
-                   .findAll("option"))
-        return {x.text: x.get("value") for x in options
-                if x.get("value") != ""}
-
-    def _parse_countries(self, list_page):
-        options = (list_page.find("select", {"id": "historic_country_id"})
-                   .findAll("option"))
-        return {x.text: x.get("value") for x in options
-                if x.get("value") != ""}
-
-    def _parse_metadata(self, mubi_id):
-        page = BS(self._session.get(self._mubi_urls["fulldetails"] % mubi_id)
-                  .content)
-        full_cast = page.findAll("h3", "film_cast")
-
-        year = page.find("h3", "film_year").text
-        rating = float(self._regexps["rating"].match(
-                 page.find("li", "current_rating").text)
-                 .group(1))
-        cast = [x.text.replace("CAST", "").split(",")
-                for x in full_cast if x.span.text == 'CAST'][0]
-        director = [x.text.replace("DIR", "").replace(",", ", ")
-                    for x in full_cast if x.span.text == 'DIR'][0]
-        plot = "\n".join([x.text for x in
-                          page.find("div", "content greenbg clear")
-                          .findAll("p")])
-        title = page.find("h1", "film_title blue").text
-        try: originaltitle = page.find("h2", "film_title notbold blue").text
-        except AttributeError: originaltitle = None
-        duration = page.find("div", text=self._regexps["duration"])
-        writer = [x.text.replace("SCR","").replace(",", ", ")
-                  for x in full_cast if x.span.text == 'SCR'][0]
-        try: playcount = int(page.find("div", "film_views").span.text
-                             .replace(",",""))
-        except AttributeError: playcount = None
-        try: trailer = (BS(self._session.get(page.find("a", "watch_trailer")
-                                             .get("href")).content)
-                        .find("div", "flashplayer").get("data-video_url"))
-        except AttributeError: trailer = None
-        try: audio_language = (self._regexps["audio_lang"].match(
-                                    page.find("div", "film_subtitle_language",
-                                              text=self._regexps["audio_lang"]))
-                               .group(1))
-        except TypeError: audio_language = None
-        try: subtitle_language = (self._regexps["sub_lang"].match(
-                                    page.find("div", "film_subtitle_language",
-                                              text=self._regexps["sub_lang"]))
-                                  .group(1))
-        except TypeError: subtitle_language = None
-        return VideoMetadata(year=year, rating=rating, cast=cast,
-                             director=director, plot=plot, title=title,
-                             originaltitle=originaltitle, duration=duration,
-                             writer=writer, playcount=playcount,
-                             trailer=trailer, audio_language=audio_language,
-                             subtitle_language=subtitle_language,
-                             plotoutline=None)
+        location = self._head(self._mubi_urls["fulldetails"] % mubi_id
+                              ).headers.get('location')
+        if not location:
+            raise Exception("Could not resolve the URL of film %s" % mubi_id)
+        return location.split("/")[-1]
+
+    def _get_taxonomy(self):
+        # Stale data is returned right away and refreshed in the background,
+        # we only block on the network if nothing has been stored yet. The
+        # age is checked on every access, a resident service keeps this
+        # instance for as long as Kodi runs.
+        with self._taxonomy_lock:
+            if self._taxonomy is None:
+                self._taxonomy = self._taxonomy_store.get("taxonomy")
+            if self._taxonomy is None:
+                return self.refresh_taxonomy()
+            if (not self._taxonomy_refreshing
+                    and self._taxonomy_store.age("taxonomy")
+                        > self._taxonomy_ttl):
+                self._logger.debug("Taxonomy is stale, refreshing")
+                self._taxonomy_refreshing = True
+                threading.Thread(target=self._refresh_stale_taxonomy).start()
+            return self._taxonomy
+
+    def _refresh_stale_taxonomy(self):
+        try:
+            self.refresh_taxonomy()
+        except Exception as e:
+            self._logger.debug("Could not refresh taxonomy: %s" % e)
+        finally:
+            self._taxonomy_refreshing = False
+
+    def refresh_taxonomy(self):
+        taxonomy = self._extractor.taxonomy(
+            self._get(self._mubi_urls["list"]).content)
+        self._taxonomy_store.set("taxonomy", taxonomy)
+        self._taxonomy_store.save()
+        self._taxonomy = taxonomy
+        return taxonomy
+
+    def _resolve_trailer(self, trailer_page):
+        if not trailer_page:
+            return None
+        try:
+            return self._extractor.trailer(
+                self._get(trailer_page).content)
+        except AttributeError:
+            return None
+
+    def _parse_metadata(self, mubi_id, resolve_trailer=True):
+        response = self._get(self._mubi_urls["fulldetails"] % mubi_id)
+        # The film page redirects from the id to the slug
+        if (response.url and response.history
+                and not self._is_login_redirect(response)):
+            self._set_slug(mubi_id, response.url.split("/")[-1])
+        info = self._extractor.metadata(response.content)
+        trailer_page = info.pop('trailer_page')
+        trailer = (self._resolve_trailer(trailer_page) if resolve_trailer
+                   else None)
+        metadata = VideoMetadata(trailer=trailer, plotoutline=None, **info)
+        if self._catalog:
+            self._catalog.store_metadata(mubi_id, metadata)
+        return metadata
+
+    def get_cached_metadata(self, film_ids):
+        """ Return the stored metadata of `film_ids` as a dictionary keyed
+        by film id, without touching the network.
+        """
+        if not self._catalog:
+            return {}
+        return self._catalog.get_metadata_many(film_ids,
+                                               max_age=self._metadata_ttl)
+
+    def get_metadata(self, mubi_id):
+        """ Return the metadata of a film from its page, without the
+        trailer, which `get_trailer` resolves separately.
+        """
+        if self._catalog:
+            cached = self._catalog.get_metadata(mubi_id,
+                                                max_age=self._metadata_ttl)
+            # Metadata from the tooltip service lacks the plot and rating
+            if cached is not None and cached.plot is not None:
+                return cached
+        return self._parse_metadata(mubi_id, resolve_trailer=False)
+
+    def get_trailer(self, mubi_id):
+        """ Resolve the trailer URL of a film and add it to its stored
+        metadata. The film page is usually served from the HTTP cache.
+        """
+        info = self._extractor.metadata(
+            self._get(self._mubi_urls["fulldetails"] % mubi_id)
+            .content)
+        trailer = self._resolve_trailer(info['trailer_page'])
+        if self._catalog and trailer:
+            metadata = self._catalog.get_metadata(mubi_id)
+            if metadata is not None:
+                self._catalog.store_metadata(
+                    mubi_id, metadata._replace(trailer=trailer))
+        return trailer
+
+    def _cookie_state(self):
+        return sorted((x.name, x.value, x.domain, x.path)
+                      for x in self._session.cookies)
+
+    def _restore_session(self):
+        session = self._session_store.get("session")
+        if not session or session.get('username') != self._username:
+            return False
+        # Sessions stored without cookie domains are not restored, their
+        # cookies would be sent to every host
+        if not isinstance(session.get('cookies'), list):
+            return False
+        for cookie in session['cookies']:
+            self._session.cookies.set(cookie['name'], cookie['value'],
+                                      domain=cookie['domain'],
+                                      path=cookie['path'],
+                                      secure=cookie['secure'],
+                                      expires=cookie['expires'])
+        self._saved_cookies = self._cookie_state()
+        self._userid = session['userid']
+        self._auth_token = session['auth_token']
+        self._logger.debug("Restored session, user ID is '%s'" % self._userid)
+        return True
+
+    def _save_session(self):
+        with self._auth_lock:
+            self._saved_cookies = self._cookie_state()
+            self._session_store.set("session", {
+                'username': self._username,
+                'userid': self._userid,
+                'auth_token': self._auth_token,
+                'cookies': [{'name': x.name, 'value': x.value,
+                             'domain': x.domain, 'path': x.path,
+                             'secure': x.secure, 'expires': x.expires}
+                            for x in self._session.cookies]})
+            self._session_store.save()
 
     def login(self, username, password):
         self._username = username
         self._password = password
+        if not self._restore_session():
+            self._authenticate()
+
+    def logout(self):
+        self._session.get(self._mubi_urls["logout"])
+        self._session_store.delete("session")
+        self._session_store.save()
+        self._stream_store.clear()
+        self._stream_store.save()
+
+    def _authenticate(self):
+        username, password = self._username, self._password
         login_page = self._session.get(self._mubi_urls["login"]).content
-        auth_token = (BS(login_page).find("input",
-                                          {"name": "authenticity_token"})
-                      .get("value"))
+        auth_token = self._extractor.auth_token(login_page)
         session_payload = {'utf8': '✓',
                            'authenticity_token': auth_token,
                            'email': username,
@@ -221,107 +439,321 @@ class Mubi(object):
                              % (username, auth_token))
         landing_page = self._session.post(self._mubi_urls["session"],
                                           data=session_payload)
-        self._userid = BS(landing_page.content).find(
-                "a", "user_avatar").get("href").split("/")[-1]
+        self._userid = self._extractor.user_id(landing_page.content)
+        self._auth_token = auth_token
         self._logger.debug("Login succesful, user ID is '%s'" % self._userid)
+        self._auth_generation += 1
+        self._save_session()
 
     def is_film_available(self, name):
+        key = "%s:%s" % (self._country_code, name)
+        available = self._availability_store.get(
+            key, max_age=self._availability_ttl)
+        if available is None:
+            available = self._check_availability(name)
+            self._availability_store.set(key, available)
+        return available
+
+    def _check_availability(self, name):
+        if self._head(self._mubi_urls["video"] % name):
+            return True
+        return self._check_prescreen(name)
+
+    def _check_prescreen(self, name):
         # Sometimes we have to load a prescreen page before we can retrieve
         # the film's URL
-        if not self._session.head(self._mubi_urls["video"] % name):
-            prescreen_page = self._session.get(self._mubi_urls["prescreen"]
-                                               % name)
-            if not prescreen_page:
-                raise Exception("Oops, something went wrong while scraping :(")
-            elif self._regexps["watch_page"].match(prescreen_page.url):
-                return True
-            else:
-                availability = BS(prescreen_page.content).find(
-                                  "div", "film_viewable_status ").text
-                return not "Not Available to watch" in availability
-        else:
+        prescreen_page = self._get(self._mubi_urls["prescreen"] % name)
+        if not prescreen_page:
+            raise Exception("Oops, something went wrong while scraping :(")
+        elif self._regexps["watch_page"].match(prescreen_page.url):
             return True
+        else:
+            return self._extractor.availability(prescreen_page.content)
+
+    def _stream_expiry(self, url):
+        # Signed stream URLs say when they expire, otherwise we assume
+        # they are good for `stream_ttl` seconds
+        query = parse_qs(urlsplit(url).query)
+        for name in ('Expires', 'expires'):
+            try:
+                return int(query[name][0]) - 60
+            except (KeyError, ValueError):
+                pass
+        return time.time() + self._stream_ttl
 
     def get_play_url(self, name):
-        if not self.is_film_available(name):
-            raise Exception("This film is not available in your country.")
-        return self._session.get(self._mubi_urls["video"] % name).content
-
-    def search_film(self, term):
-        results = self._search(term)
-        filtered = [x for x in results if x['category'] == "Films"]
-        final = [Film(title=x['label'],
-                      mubi_id=x['id'],
-                      filmstill=self._get_filmstill(x['url'].split("/")[-1]))
-                 for x in filtered if self.is_film_available(x['id'])]
-        return final
+        """ Return the stream URL of a film.
+
+        The URL is requested right away, the availability check and the
+        prescreen page are only needed if that fails. Resolved URLs are
+        reused until they expire.
+        """
+        cached = self._stream_store.get(unicode(name))
+        if cached is not None and cached[1] > time.time():
+            return cached[0]
+        response = self._get(self._mubi_urls["video"] % name)
+        if not response:
+            available = self._check_prescreen(name)
+            self._availability_store.set(
+                "%s:%s" % (self._country_code, name), available)
+            self._availability_store.save()
+            if not available:
+                raise Exception("This film is not available in your country.")
+            response = self._get(self._mubi_urls["video"] % name)
+            if not response:
+                raise Exception("Oops, something went wrong while scraping :(")
+        url = response.content
+        self._availability_store.set("%s:%s" % (self._country_code, name),
+                                     True)
+        self._availability_store.save()
+        self._stream_store.set(unicode(name), [url, self._stream_expiry(url)])
+        self._stream_store.save()
+        return url
+
+    def search_film(self, term, check_availability=True):
+        """ Search for films matching `term`.
+
+        Results are served from the catalog if the same search was made
+        recently, or if a full catalog sync completed less than
+        `local_search_ttl` seconds ago and found matching films. If
+        `check_availability` is False, unavailable films are not filtered
+        out; availability is then only checked once a film is played.
+        """
+        return list(self.iter_search_film(term, check_availability))
+
+    def _catalog_is_synced(self):
+        if not self._catalog:
+            return False
+        last_sync = self._catalog.get_meta("last_sync")
+        return (last_sync is not None
+                and time.time() - last_sync < self._local_search_ttl)
+
+    def iter_search_film(self, term, check_availability=True):
+        """ Like `search_film`, but yield each film as soon as its
+        availability is known.
+        """
+        key = "search:film:%s" % term.lower()
+        cached = self._cached_listing(key)
+        films = None
+        if cached is not None:
+            films = cached[1]
+        elif self._catalog_is_synced():
+            films = self._catalog.search_films(term) or None
+        if films is None:
+            results = self._search(term)
+            films = [Film(title=x['label'],
+                          mubi_id=x['id'],
+                          filmstill=self._get_filmstill(
+                              x['url'].split("/")[-1]))
+                     for x in results if x['category'] == "Films"]
+            self._store_listing(key, 'film', films)
+            self._slug_store.save()
+        if not check_availability:
+            for film in films:
+                yield film
+            return
+        try:
+            for film, available in parallel_imap(
+                    lambda x: (x, self.is_film_available(x.mubi_id)),
+                    films, self._max_workers):
+                if available:
+                    yield film
+        finally:
+            self._availability_store.save()
 
     def search_person(self, term):
-        results = self._search(term)
+        key = "search:person:%s" % term.lower()
+        cached = self._cached_listing(key)
+        if cached is not None:
+            return cached[1]
+        results = [x for x in self._search(term)
+                   if x['category'] == "People"]
+        portraits = parallel_map(lambda x: self._get_person_image(x['id']),
+                                 results, self._max_workers)
+        self._portrait_store.save()
         final = [Person(name=x['label'],
                         mubi_id=x['id'],
-                        portrait=self._get_person_image(x['id']))
-                 for x in results if x['category'] == "People"]
+                        portrait=portrait)
+                 for x, portrait in zip(results, portraits)]
+        self._store_listing(key, 'person', final)
         return final
 
     def get_person_films(self, person_id):
-        person_page = self._session.get(self._mubi_urls["person"] % person_id)
-        return self._parse_watchable_titles(person_page.content)
+        key = "person:%s" % person_id
+        cached = self._cached_listing(key)
+        if cached is not None:
+            return cached[1]
+        person_page = self._get(self._mubi_urls["person"] % person_id)
+        films = self._extractor.watchable_titles(person_page.content)
+        self._store_listing(key, 'film', films)
+        self._slug_store.save()
+        return films
 
     def get_all_films(self, page=1, sort_key='popularity', genre=None,
-                      country=None, language=None):
+                      country=None, language=None, refresh=False):
+        result = self._get_all_films(page, sort_key, genre, country,
+                                     language, refresh)
+        self._slug_store.save()
+        return result
+
+    def _get_all_films(self, page=1, sort_key='popularity', genre=None,
+                       country=None, language=None, refresh=False):
         if sort_key not in self._SORT_KEYS:
             raise Exception("Invalid sort key, must be one of %s"
                             % self._SORT_KEYS.__repr__())
+        key = "films:%s:%s:%s:%s:%s" % (sort_key, genre, country, language,
+                                        page)
+        cached = None if refresh else self._cached_listing(key)
+        if cached is not None:
+            return cached
+        # Refreshed pages, i.e. those of a catalog crawl, would only push
+        # the pages the user browses out of the HTTP cache
+        num_pages, films = self._fetch_all_films(page, sort_key, genre,
+                                                 country, language,
+                                                 cache=not refresh)
+        self._store_listing(key, 'film', films, num_pages)
+        return (num_pages, films)
+
+    def _fetch_all_films(self, page, sort_key, genre, country, language,
+                         cache=True):
         params = {'page': page,
                   'sort': sort_key}
         if genre:
             params["category_id"] = genre
-        elif country:
+        if country:
             params["historic_country_id"] = country
-        elif language:
+        if language:
             params["language_id"] = language
         list_url = urljoin(self._mubi_urls["list"], "?" + urlencode(params))
-        list_page = self._session.get(list_url)
-        num_pages = ceil(int(BS(list_page.content)
-                         .find("strong", {"id": "result_count"}).text
-                         .split()[0]) / 20.0)
-        return (num_pages, self._parse_watchable_titles(list_page.content))
+        return self._extractor.listing(self._get(list_url, cache=cache)
+                                       .content)
+
+    def get_films_page(self, page=1, per_page=PAGE_SIZE,
+                       sort_key='popularity', order_by=None, **filters):
+        """ Return the number of pages and the films of a page holding
+        `per_page` films, stitched together from as many MUBI listing
+        pages, which are fetched concurrently.
+
+        `order_by` sorts the films of the page with `sort_films`.
+        """
+        num_pages, films = self.iter_films_page(page, per_page, sort_key,
+                                                **filters)
+        films = list(films)
+        if order_by:
+            films = self.sort_films(films, order_by)
+        return (num_pages, films)
+
+    def iter_films_page(self, page=1, per_page=PAGE_SIZE,
+                        sort_key='popularity', **filters):
+        """ Like `get_films_page`, but only wait for the first MUBI page.
+        The films are returned as an iterator that yields those of the
+        following pages as they arrive.
+        """
+        ratio = max(1, (per_page + PAGE_SIZE - 1) // PAGE_SIZE)
+        first = (page - 1) * ratio + 1
+        num_pages, films = self._get_all_films(first, sort_key, **filters)
+        num_pages = int(num_pages)
+        rest = parallel_imap(
+            lambda x: self._get_all_films(x, sort_key, **filters)[1],
+            range(first + 1, min(first + ratio, num_pages + 1)),
+            self._max_workers)
+
+        def stitch():
+            try:
+                for film in films:
+                    yield film
+                for more in rest:
+                    for film in more:
+                        yield film
+            finally:
+                self._slug_store.save()
+        return ((num_pages + ratio - 1) // ratio, stitch())
+
+    def sort_films(self, films, sort_key):
+        """ Sort `films` by one of `_SORT_KEYS` with the data that is
+        stored locally. Films lacking it keep their order at the end, and
+        'popularity' leaves the order as it is, since only MUBI knows it.
+        """
+        if sort_key not in self._SORT_KEYS:
+            raise Exception("Invalid sort key, must be one of %s"
+                            % self._SORT_KEYS.__repr__())
+        if sort_key == 'popularity' or not self._catalog:
+            return films
+        films = list(films)
+        film_ids = [x.mubi_id for x in films]
+        if sort_key == 'recently_added':
+            values = self._catalog.added_times(film_ids)
+        else:
+            field = {'rating': 'rating', 'year': 'year',
+                     'running_time': 'duration'}[sort_key]
+            values = {}
+            for mubi_id, metadata in self.get_cached_metadata(
+                    film_ids).items():
+                try:
+                    values[mubi_id] = float(getattr(metadata, field))
+                except (TypeError, ValueError):
+                    pass
+        # Shortest films first, highest values first otherwise
+        sign = 1 if sort_key == 'running_time' else -1
+
+        def key(film):
+            value = values.get(int(film.mubi_id))
+            return (value is None, sign * value if value is not None else 0)
+        return sorted(films, key=key)
 
     def get_all_programs(self):
-        programs_page = self._session.get(self._mubi_urls["programs"])
-        programs = (BS(programs_page.content)
-                    .findAll("div", {"class": self._regexps["program"]}))
-        return [Program(title=x.find("h2").text,
-                        identifier=x.find("a").get("href").split("/")[-1],
-                        picture=x.find("img").get("src"))
-                for x in programs]
+        cached = self._cached_listing("programs")
+        if cached is not None:
+            return cached[1]
+        programs = self._extractor.programs(
+            self._get(self._mubi_urls["programs"]).content)
+        self._store_listing("programs", 'program', programs)
+        return programs
 
     def get_program_films(self, cinema):
-        program_page = self._session.get("/"
-                .join([self._mubi_urls["single_program"], cinema]))
-        items = (BS(program_page.content)
-                 .findAll("div", {"class": self._regexps["item"]}))
-        films = []
-        for item in items:
-            film = dict()
-            film['id'] = item.get("data-item-id")
-            film['title'] = item.find("h2", "film_title ").text
-            film['director'] = item.find("h2", "film_director"
-                                         ).find("a").text
-            film['country_year'] = item.find("h3", "film_country_year").text
-            film['thumb'] = item.find("img").get("src").replace("w320", "w448")
-            films.append(film)
-        return [Film(title="%s: %s (%s)" % (x['director'], x['title'],
-                                            x['country_year']),
-                     mubi_id=x['id'],
-                     filmstill=x['thumb'])
-                for x in films]
+        key = "program:%s" % cinema
+        cached = self._cached_listing(key)
+        if cached is not None:
+            return cached[1]
+        # Films are stored with their own title, the program's label for
+        # them only applies to this listing
+        entries = self._extractor.program_films(
+            self._get("/".join([self._mubi_urls["single_program"], cinema]))
+            .content)
+        films = [film for film, label in entries]
+        labels = [label for film, label in entries]
+        self._store_listing(key, 'film', films, labels=labels)
+        self._slug_store.save()
+        return [film._replace(title=label) for film, label in entries]
+
+    def _get_shortdetails_safe(self, mubi_id):
+        try:
+            return self._get_shortdetails(mubi_id)
+        except Exception as e:
+            self._logger.debug("Could not fetch details for film '%s': %s"
+                               % (mubi_id, e))
+            return (Film(title=unicode(mubi_id), mubi_id=mubi_id,
+                         filmstill=None), None)
 
     def get_watchlist(self, userid=None):
+        return list(self.iter_watchlist(userid))
+
+    def iter_watchlist(self, userid=None):
+        """ Yield a `(Film, VideoMetadata)` pair for every film on the
+        watchlist as soon as its details have been fetched. The metadata
+        is None if they couldn't be.
+        """
         if not userid:
             userid = self._userid
-        return [self._get_shortdetails(x)
-                for x in json.loads(self._session
-                                    .get(self._mubi_urls["watchlist"] % userid)
-                                    .content)]
+        film_ids = json.loads(self._get(self._mubi_urls["watchlist"]
+                                        % userid).content)
+        try:
+            for film, metadata in parallel_imap(self._get_shortdetails_safe,
+                                                film_ids, self._max_workers):
+                if self._catalog and metadata is not None:
+                    self._catalog.store_films([film])
+                    self._catalog.store_metadata(film.mubi_id, metadata,
+                                                 replace=False)
+                yield film, metadata
+        finally:
+            self._slug_store.save()
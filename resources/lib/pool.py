@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012, Johannes Baiter (jbaiter)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import threading
+import time
+
+
+def parallel_map(func, items, max_workers=8):
+    """ Apply `func` to every element of `items` using a bounded number of
+    threads and return the results in the order of `items`.
+
+    If any call raises, no further items are started and the first
+    exception is re-raised once the running calls have finished.
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(x) for x in items]
+    results = [None] * len(items)
+    errors = []
+    indices = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if errors:
+                    return
+                try:
+                    idx = next(indices)
+                except StopIteration:
+                    return
+            try:
+                results[idx] = func(items[idx])
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                return
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def parallel_imap(func, items, max_workers=8):
+    """ Like `parallel_map`, but yield the results in the order of `items`
+    as soon as each one is ready.
+
+    No more than `2 * max_workers` items are taken from `items` ahead of
+    the consumer, so `items` may be lazy and long. An exception is raised
+    when its item's turn comes; closing the generator stops the workers.
+    """
+    if max_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    items = iter(items)
+    window = 2 * max_workers
+    cond = threading.Condition()
+    results = {}
+    state = {'started': 0, 'consumed': 0, 'total': None, 'stop': False}
+
+    def worker():
+        while True:
+            with cond:
+                while (not state['stop'] and state['total'] is None
+                       and state['started'] - state['consumed'] >= window):
+                    cond.wait()
+                if state['stop'] or state['total'] is not None:
+                    return
+                try:
+                    item = next(items)
+                except StopIteration:
+                    state['total'] = state['started']
+                    cond.notify_all()
+                    return
+                idx = state['started']
+                state['started'] += 1
+            try:
+                result = (True, func(item))
+            except Exception as e:
+                result = (False, e)
+            with cond:
+                results[idx] = result
+                cond.notify_all()
+
+    for _ in range(max_workers):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+    try:
+        idx = 0
+        while True:
+            with cond:
+                while idx not in results and (state['total'] is None
+                                              or idx < state['total']):
+                    cond.wait()
+                if idx not in results:
+                    return
+                ok, value = results.pop(idx)
+                state['consumed'] = idx + 1
+                cond.notify_all()
+            if not ok:
+                raise value
+            yield value
+            idx += 1
+    finally:
+        with cond:
+            state['stop'] = True
+            cond.notify_all()
+
+
+class RateLimiter(object):
+    """ Token bucket that lets `rate` calls per second through on average,
+    with bursts of up to `burst` calls. A `rate` of 0 disables limiting.
+    """
+    def __init__(self, rate, burst=1):
+        self._rate = float(rate)
+        self._burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Block until the caller may proceed. """
+        if self._rate <= 0:
+            return
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self._burst,
+                               self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """ RateLimiter that halves its rate, down to `min_rate`, whenever the
+    server pushes back, and climbs back towards `rate` by a tenth of it
+    with every request that goes through.
+
+    With a `rate` of 0 calls go through unlimited until the server pushes
+    back for the first time. Limiting then starts from `burst` calls per
+    second and ends once the rate has climbed back there.
+    """
+    def __init__(self, rate, burst=1, min_rate=0.5):
+        super(AdaptiveRateLimiter, self).__init__(rate, burst)
+        self._max_rate = float(rate)
+        self._ceiling = self._max_rate if self._max_rate > 0 else float(burst)
+        self._min_rate = min(float(min_rate), self._ceiling)
+
+    def throttle(self):
+        with self._lock:
+            if self._rate <= 0:
+                self._rate = self._ceiling
+                self._last = time.time()
+            self._rate = max(self._min_rate, self._rate / 2)
+
+    def relax(self):
+        with self._lock:
+            if self._rate <= 0:
+                return
+            self._rate += self._ceiling / 10
+            if self._rate >= self._ceiling:
+                self._rate = self._max_rate
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012, Johannes Baiter (jbaiter)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import logging
+import os
+import threading
+
+from resources.lib.records import PAGE_SIZE
+
+
+class Prefetcher(object):
+    """ Reads ahead the film listing pages that follow the one that is
+    being displayed, so they are already cached when the user pages
+    forward.
+
+    Pages hold `per_page` films, as in `Mubi.get_films_page`. At most
+    `depth` pages are fetched, and no further page is started once
+    `max_bytes` have been downloaded (None means no limit). If an
+    `ImageCache` is given, the film stills of the pages are downloaded as
+    well.
+    """
+    def __init__(self, mubi, depth=1, max_bytes=None, images=None,
+                 per_page=PAGE_SIZE):
+        self._logger = logging.getLogger('mubi.Prefetcher')
+        self._mubi = mubi
+        self._depth = depth
+        self._max_bytes = max_bytes
+        self._images = images
+        self._per_page = per_page
+
+    def _fetch_images(self, urls):
+        """ Download the images of `urls` that aren't cached yet and return
+        the number of bytes that took.
+        """
+        missing = [x for x in set(urls)
+                   if x and self._images.local_path(x) is None]
+        received = 0
+        for url, path in zip(missing, self._images.fetch_all(missing)):
+            try:
+                received += os.path.getsize(path) if path != url else 0
+            except OSError:
+                pass
+        return received
+
+    def run(self, page, num_pages, **filters):
+        # Only our own downloads count against the budget. The metadata
+        # resolver and the thumbnails of the displayed page download at the
+        # same time, but through other URL classes and calls.
+        start_bytes = self._mubi.bytes_received_for('listing')
+        images_received = 0
+        for next_page in range(page + 1,
+                               min(page + self._depth, int(num_pages)) + 1):
+            received = (self._mubi.bytes_received_for('listing')
+                        - start_bytes + images_received)
+            if self._max_bytes is not None and received >= self._max_bytes:
+                self._logger.debug("Prefetch budget exhausted after %d bytes"
+                                   % received)
+                break
+            try:
+                num_pages, films = self._mubi.get_films_page(
+                    page=next_page, per_page=self._per_page, **filters)
+            except Exception as e:
+                self._logger.debug("Could not prefetch page %d: %s"
+                                   % (next_page, e))
+                break
+            if self._images is not None:
+                images_received += self._fetch_images(
+                    [x.filmstill for x in films])
+
+    def start(self, page, num_pages, **filters):
+        """ Run the prefetch in a background thread. """
+        if self._depth <= 0 or page >= num_pages:
+            return None
+        thread = threading.Thread(target=self.run, args=(page, num_pages),
+                                  kwargs=filters)
+        thread.start()
+        return thread
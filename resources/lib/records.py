@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012, Johannes Baiter (jbaiter)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import re
+from collections import namedtuple
+
+FILMSTILL_URL = ("http://s3.amazonaws.com/auteurs_production/images/film/"
+                 "%s/%s/%s.jpg")
+PORTRAIT_URL = ("http://s3.amazonaws.com/auteurs_production/images/"
+                "cast_member/%s/original.%s")
+
+# Stills and portraits are kept as the parts that tell them apart, a still
+# as '@<name>/<size>' and a portrait as '#<person id>.<extension>'. Other
+# URLs are kept as they are.
+_FILMSTILL_RE = re.compile("^%s$" % (re.escape(FILMSTILL_URL)
+                                     .replace(re.escape("%s"), "([^/]+)", 2)
+                                     .replace(re.escape("%s"), r"\1")))
+_PORTRAIT_RE = re.compile("^%s$" % re.escape(PORTRAIT_URL)
+                                   .replace(re.escape("%s"), "([^/]+)", 1)
+                                   .replace(re.escape("%s"), "(jpe?g)"))
+
+# Films per page of MUBI's listings, and the orders it can list them in
+PAGE_SIZE = 20
+SORT_KEYS = ['popularity', 'recently_added', 'rating', 'year', 'running_time']
+
+# Names shared by intern_name. Neither intern() nor weak references work
+# with unicode, so the table is emptied once it holds _MAX_NAMES, which
+# keeps it bounded in the resident service.
+_MAX_NAMES = 10000
+_names = {}
+
+
+def pack_url(url):
+    """ Return the short form of a film still or portrait URL. """
+    if not url:
+        return url
+    match = _FILMSTILL_RE.match(url)
+    if match:
+        return u"@%s/%s" % match.groups()
+    match = _PORTRAIT_RE.match(url)
+    if match:
+        return u"#%s.%s" % match.groups()
+    return url
+
+
+def unpack_url(value):
+    """ Turn the output of `pack_url` back into the URL. """
+    if not value:
+        return value
+    if value[0] == u"@":
+        name, size = value[1:].split(u"/", 1)
+        return FILMSTILL_URL % (name, size, name)
+    if value[0] == u"#":
+        person_id, extension = value[1:].rsplit(u".", 1)
+        return PORTRAIT_URL % (person_id, extension)
+    return value
+
+
+def intern_name(name):
+    """ Return a shared copy of `name`, so that names that occur in many
+    records, such as those of actors and directors, are stored once.
+    """
+    if name is None:
+        return None
+    if len(_names) >= _MAX_NAMES:
+        _names.clear()
+    return _names.setdefault(name, name)
+
+
+def _compact_id(mubi_id):
+    try:
+        return int(mubi_id)
+    except (TypeError, ValueError):
+        return mubi_id
+
+
+class Film(namedtuple('Film', ['title', 'mubi_id', 'still'])):
+    """ A film, its still URL is stored packed and `filmstill` unpacks
+    it.
+    """
+    __slots__ = ()
+
+    def __new__(cls, title, mubi_id, filmstill):
+        return super(Film, cls).__new__(cls, title, _compact_id(mubi_id),
+                                        pack_url(filmstill))
+
+    @property
+    def filmstill(self):
+        return unpack_url(self.still)
+
+
+class Person(namedtuple('Person', ['name', 'mubi_id', 'packed_portrait'])):
+    """ A person, its portrait URL is stored packed and `portrait` unpacks
+    it.
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, mubi_id, portrait):
+        return super(Person, cls).__new__(cls, intern_name(name),
+                                          _compact_id(mubi_id),
+                                          pack_url(portrait))
+
+    @property
+    def portrait(self):
+        return unpack_url(self.packed_portrait)
+
+
+Program = namedtuple('Program', ['title', 'identifier', 'picture'])
+
+
+class VideoMetadata(namedtuple('VideoMetadata',
+                               ['year', 'rating', 'cast', 'director', 'plot',
+                                'title', 'originaltitle', 'duration',
+                                'writer', 'playcount', 'trailer',
+                                'audio_language', 'subtitle_language',
+                                'plotoutline'])):
+    """ Details of a film. The cast is a tuple, and names and languages
+    are interned.
+    """
+    __slots__ = ()
+    _NAMES = ('director', 'writer', 'audio_language', 'subtitle_language')
+
+    def __new__(cls, *args, **kwargs):
+        record = super(VideoMetadata, cls).__new__(cls, *args, **kwargs)
+        values = dict((name, intern_name(getattr(record, name)))
+                      for name in cls._NAMES)
+        if record.cast is not None:
+            values['cast'] = tuple(intern_name(x) for x in record.cast)
+        return record._replace(**values)
+
+    def pack(self):
+        """ Return the fields as a list, to be serialized and handed to
+        `unpack`. This is more compact than a dictionary.
+        """
+        return list(self)
+
+    @classmethod
+    def unpack(cls, data):
+        """ Recreate metadata from the output of `pack` or, as it used to
+        be stored, from a dictionary.
+        """
+        if isinstance(data, dict):
+            return cls(**data)
+        return cls(*data)
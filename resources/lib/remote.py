@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012, Johannes Baiter (jbaiter)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import json
+import logging
+import socket
+import threading
+import types
+from SocketServer import StreamRequestHandler, TCPServer, ThreadingMixIn
+
+from resources.lib import records
+from resources.lib.prefetch import Prefetcher
+from resources.lib.resolver import MetadataResolver
+
+# Mubi methods and properties the service answers for its clients
+_METHODS = ('search_film', 'search_person', 'get_person_films',
+            'get_all_films', 'get_films_page', 'sort_films',
+            'get_all_programs', 'get_program_films',
+            'get_watchlist', 'iter_search_film', 'iter_watchlist',
+            'iter_films_page', 'get_play_url', 'is_film_available',
+            'get_cached_metadata', 'get_metadata', 'get_trailer',
+            'refresh_taxonomy')
+_PROPERTIES = ('genres', 'countries', 'languages', 'bytes_received')
+_RECORDS = dict((cls.__name__, cls)
+                for cls in (records.Film, records.Person, records.Program,
+                            records.VideoMetadata))
+
+
+def encode(value):
+    """ Turn `value` into something JSON can carry without losing the
+    record types and non-string dictionary keys. Generators are consumed,
+    the client gets their items as a list.
+    """
+    if type(value).__name__ in _RECORDS and isinstance(value, tuple):
+        return {'__record__': type(value).__name__,
+                'fields': [encode(x) for x in value]}
+    if isinstance(value, (list, tuple, types.GeneratorType)):
+        return [encode(x) for x in value]
+    if isinstance(value, dict):
+        return {'__items__': [[encode(k), encode(v)]
+                              for k, v in value.items()]}
+    return value
+
+
+def decode(value):
+    if isinstance(value, list):
+        return [decode(x) for x in value]
+    if isinstance(value, dict):
+        if '__record__' in value:
+            return _RECORDS[value['__record__']](
+                *[decode(x) for x in value['fields']])
+        return dict((decode(k), decode(v)) for k, v in value['__items__'])
+    return value
+
+
+class _Handler(StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            result = self.server.dispatch(request['name'],
+                                          decode(request.get('args', [])),
+                                          decode(request.get('kwargs', {})))
+            response = {'result': encode(result)}
+        except Exception as e:
+            self.server.logger.debug("Request failed: %s" % e)
+            response = {'error': unicode(e)}
+        self.wfile.write(json.dumps(response).encode('utf-8') + b"\n")
+
+
+class MubiServer(ThreadingMixIn, TCPServer):
+    """ Serves the methods of a warm `Mubi` instance on a local port, one
+    JSON request and response line per connection.
+
+    `prefetch` and `resolve_metadata` are called with the arguments of
+    `Prefetcher.start` and `MetadataResolver.start`, so that background
+    work requested by a client runs in the service as well.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mubi, port, prefetch=None, resolve_metadata=None):
+        TCPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.logger = logging.getLogger('mubi.MubiServer')
+        self._mubi = mubi
+        self._tasks = {'prefetch': prefetch,
+                       'resolve_metadata': resolve_metadata}
+
+    def dispatch(self, name, args, kwargs):
+        if name == 'ping':
+            return True
+        if name in _PROPERTIES:
+            return getattr(self._mubi, name)
+        if name in _METHODS:
+            return getattr(self._mubi, name)(*args, **kwargs)
+        if self._tasks.get(name) is not None:
+            self._tasks[name](*args, **kwargs)
+            return None
+        raise Exception("Unknown method '%s'" % name)
+
+    def start(self):
+        """ Serve requests in a background thread. """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class MubiClient(object):
+    """ Stands in for `Mubi` in the plugin when the service is running,
+    forwarding every call to the `MubiServer` on `port`.
+    """
+    def __init__(self, port, timeout=60):
+        self._port = port
+        self._timeout = timeout
+
+    def _call(self, name, *args, **kwargs):
+        conn = socket.create_connection(('127.0.0.1', self._port),
+                                        self._timeout)
+        try:
+            conn.sendall(json.dumps({'name': name, 'args': encode(args),
+                                     'kwargs': encode(kwargs)})
+                         .encode('utf-8') + b"\n")
+            fp = conn.makefile('rb')
+            response = json.loads(fp.readline().decode('utf-8'))
+            fp.close()
+        finally:
+            conn.close()
+        if 'error' in response:
+            raise Exception(response['error'])
+        return decode(response['result'])
+
+    def __getattr__(self, name):
+        if name in _PROPERTIES:
+            return self._call(name)
+        if name in _METHODS or name in ('prefetch', 'resolve_metadata'):
+            return lambda *args, **kwargs: self._call(name, *args, **kwargs)
+        raise AttributeError(name)
+
+    def ping(self):
+        try:
+            return self._call('ping')
+        except (socket.error, ValueError):
+            return False
+
+
+def connect(port, timeout=60):
+    """ Return a `MubiClient` for the service on `port`, or None if the
+    service isn't running.
+    """
+    client = MubiClient(port, timeout)
+    return client if client.ping() else None
+
+
+class RemotePrefetcher(Prefetcher):
+    """ Hands the read-ahead over to the service behind a `MubiClient`. """
+    def start(self, page, num_pages, **filters):
+        self._mubi.prefetch(page, num_pages, **filters)
+
+
+class RemoteResolver(MetadataResolver):
+    """ Hands metadata resolution over to the service behind a
+    `MubiClient`.
+    """
+    def start(self, film_ids):
+        film_ids = list(film_ids)
+        if film_ids:
+            self._mubi.resolve_metadata(film_ids)
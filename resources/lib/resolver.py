@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012, Johannes Baiter (jbaiter)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import logging
+import threading
+
+from resources.lib.pool import parallel_map
+
+
+class MetadataResolver(object):
+    """ Fills in the metadata of listed films in the background, so that
+    folders can be rendered from what is already stored and the info
+    panels are complete the next time they are shown.
+
+    Trailers live on a page of their own and are only resolved when
+    `trailers` is set, once the metadata of all queued films is in.
+    """
+    def __init__(self, mubi, max_workers=2, trailers=False):
+        self._logger = logging.getLogger('mubi.MetadataResolver')
+        self._mubi = mubi
+        self._max_workers = max_workers
+        self._trailers = trailers
+
+    def missing(self, film_ids, cached):
+        """ Return the ids from `film_ids` that have no complete entry in
+        `cached`, as returned by `Mubi.get_cached_metadata`.
+        """
+        return [x for x in film_ids
+                if cached.get(int(x)) is None or cached[int(x)].plot is None]
+
+    def _resolve(self, mubi_id):
+        try:
+            return self._mubi.get_metadata(mubi_id)
+        except Exception as e:
+            self._logger.debug("Could not resolve metadata of film '%s': %s"
+                               % (mubi_id, e))
+            return None
+
+    def _resolve_trailer(self, mubi_id):
+        try:
+            return self._mubi.get_trailer(mubi_id)
+        except Exception as e:
+            self._logger.debug("Could not resolve trailer of film '%s': %s"
+                               % (mubi_id, e))
+            return None
+
+    def run(self, film_ids):
+        results = parallel_map(self._resolve, film_ids, self._max_workers)
+        if self._trailers:
+            parallel_map(self._resolve_trailer,
+                         [x for x, metadata in zip(film_ids, results)
+                          if metadata is not None and not metadata.trailer],
+                         self._max_workers)
+
+    def start(self, film_ids):
+        """ Resolve the metadata of `film_ids` in a background thread. """
+        film_ids = list(film_ids)
+        if not film_ids:
+            return None
+        thread = threading.Thread(target=self.run, args=(film_ids,))
+        thread.start()
+        return thread
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012, Johannes Baiter (jbaiter)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+class JSONStore(object):
+    """ Small key/value store that is persisted as a JSON file.
+
+    Every entry carries the time it was written, so callers can ask for
+    values no older than a given age. If the file on disk was written with
+    a different `version`, it is discarded.
+    """
+    def __init__(self, path, version=1):
+        self._logger = logging.getLogger('mubi.JSONStore')
+        self._path = path
+        self._version = version
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        # Keys written or deleted since the last save, and whether the
+        # store was cleared
+        self._changed = set()
+        self._cleared = False
+        self._dirty = False
+        self._entries = self._read()
+
+    def _read(self):
+        if not self._path or not os.path.exists(self._path):
+            return {}
+        try:
+            with open(self._path, 'rb') as fp:
+                data = json.loads(fp.read().decode('utf-8'))
+        except (IOError, ValueError) as e:
+            self._logger.debug("Could not read store '%s': %s"
+                               % (self._path, e))
+            return {}
+        if data.get('version') != self._version:
+            self._logger.debug("Discarding store '%s', version mismatch"
+                               % self._path)
+            return {}
+        return data.get('entries', {})
+
+    def get(self, key, default=None, max_age=None):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return default
+        timestamp, value = entry
+        if max_age is not None and (time.time() - timestamp) > max_age:
+            return default
+        return value
+
+    def age(self, key):
+        """ Return the number of seconds since `key` was written, or None. """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return time.time() - entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = [time.time(), value]
+            self._changed.add(key)
+            self._dirty = True
+
+    def delete(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._changed.add(key)
+                self._dirty = True
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._changed = set()
+            self._cleared = True
+            self._dirty = True
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def save(self):
+        """ Write the store to disk if it was modified. The plugin and the
+        service share the files, so the file is read again first and only
+        the entries changed here are overwritten, the others are taken
+        over from the file.
+        """
+        # Writes are serialized and go through a temporary file of their
+        # own, so concurrent saves can't clobber each other's file.
+        with self._save_lock:
+            with self._lock:
+                if not self._path or not self._dirty:
+                    return
+                entries = {} if self._cleared else self._read()
+                for key in self._changed:
+                    if key in self._entries:
+                        entries[key] = self._entries[key]
+                    else:
+                        entries.pop(key, None)
+                self._entries = entries
+                data = json.dumps({'version': self._version,
+                                   'entries': entries})
+                self._changed = set()
+                self._cleared = False
+                self._dirty = False
+            directory = os.path.dirname(self._path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp_path = tempfile.mkstemp(dir=directory or None,
+                                            suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data.encode('utf-8'))
+            if os.name == 'nt' and os.path.exists(self._path):
+                # Windows won't rename over an existing file
+                os.remove(self._path)
+            os.rename(tmp_path, self._path)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012, Johannes Baiter (jbaiter)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import logging
+import time
+
+from resources.lib.pool import RateLimiter, parallel_map
+
+
+class CatalogSync(object):
+    """ Crawls the MUBI film listings into the catalog.
+
+    The first crawl of a scope (all films, or a single genre, country or
+    language) walks every listing page. Later crawls walk the listing
+    sorted by date added and stop at the first page that contains a film
+    that is already in the catalog. The current page is checkpointed in
+    the catalog, so an interrupted crawl picks up where it stopped.
+    """
+    def __init__(self, mubi, catalog, max_workers=2, rate=1.0):
+        self._logger = logging.getLogger('mubi.CatalogSync')
+        self._mubi = mubi
+        self._catalog = catalog
+        self._max_workers = max_workers
+        self._limiter = RateLimiter(rate)
+
+    def _fetch_page(self, page, genre, country, language):
+        self._limiter.acquire()
+        return self._mubi.get_all_films(page=page, sort_key='recently_added',
+                                        genre=genre, country=country,
+                                        language=language, refresh=True)
+
+    def last_run(self, genre=None, country=None, language=None):
+        """ Return when a crawl of the scope last completed, or None. """
+        return self._catalog.get_meta("sync_done:%s:%s:%s"
+                                      % (genre, country, language))
+
+    def run(self, genre=None, country=None, language=None, progress=None):
+        """ Crawl a scope, returning True if it was completed.
+
+        `progress` is called with the last crawled page and the total
+        number of pages; if it returns False, the crawl is stopped and will
+        be resumed from the checkpoint on the next run.
+        """
+        scope = "%s:%s:%s" % (genre, country, language)
+        checkpoint_key = "sync_checkpoint:%s" % scope
+        done_key = "sync_done:%s" % scope
+        incremental = self._catalog.get_meta(done_key) is not None
+        checkpoint = self._catalog.get_meta(checkpoint_key) or {}
+        page = checkpoint.get('page', 1)
+        num_pages = checkpoint.get('num_pages', page)
+        self._logger.debug("Crawling '%s' from page %d (incremental: %s)"
+                           % (scope, page, incremental))
+        caught_up = False
+        while page <= num_pages and not caught_up:
+            started = time.time()
+            batch = range(page, min(page + self._max_workers, num_pages + 1))
+            results = parallel_map(
+                lambda x: self._fetch_page(x, genre, country, language),
+                batch, self._max_workers)
+            # get_all_films has already stored the pages, so we look for
+            # films that were added to the catalog before this batch.
+            for (num_pages, films) in results:
+                num_pages = int(num_pages)
+                if incremental and self._catalog.known_film_ids(
+                        [x.mubi_id for x in films], added_before=started):
+                    caught_up = True
+                    break
+            page = batch[-1] + 1
+            self._catalog.set_meta(checkpoint_key, {'page': page,
+                                                    'num_pages': num_pages})
+            if progress and progress(page - 1, num_pages) is False:
+                return False
+        self._catalog.set_meta(checkpoint_key, None)
+        self._catalog.set_meta(done_key, time.time())
+        if (genre, country, language) == (None, None, None):
+            self._catalog.set_meta("last_sync", time.time())
+        return True
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012, Johannes Baiter (jbaiter)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import time
+from contextlib import contextmanager
+
+
+class Tracer(object):
+    """ Records HTTP requests, page parsing and plugin routes with their
+    timings as JSON lines in a rotating log file at `path`.
+
+    Every record has a `type` ('request', 'parse' or 'route'), a `name`
+    (the URL class, the extractor method or the route) and the `elapsed`
+    time in seconds; requests also carry their method, status, body size
+    and whether they were served from the cache.
+    """
+    def __init__(self, path, max_bytes=1024*1024, backup_count=3):
+        self._path = path
+        self._backup_count = backup_count
+        self._log = logging.getLogger('mubi.trace.%s' % path)
+        self._log.propagate = False
+        self._log.setLevel(logging.INFO)
+        if not self._log.handlers:
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backup_count)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._log.addHandler(handler)
+
+    def record(self, type, name, elapsed, **fields):
+        fields.update({'time': time.time(), 'type': type, 'name': name,
+                       'elapsed': round(elapsed, 4)})
+        self._log.info(json.dumps(fields, sort_keys=True))
+
+    def record_request(self, url_class, method, response, elapsed):
+        self.record('request', url_class, elapsed, method=method.upper(),
+                    status=response.status_code,
+                    bytes=len(response.content or b''),
+                    cached=getattr(response, 'from_cache', False))
+
+    @contextmanager
+    def span(self, type, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(type, name, time.time() - start)
+
+    def trace_route(self, func):
+        """ Decorator that records the total time spent in a route. """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.span('route', func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def _records(self):
+        paths = ["%s.%d" % (self._path, x)
+                 for x in range(self._backup_count, 0, -1)] + [self._path]
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            with open(path) as fp:
+                for line in fp:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+
+    def summary(self):
+        """ Aggregate the log by record type and name into a list of dicts
+        with count, total, mean and maximum time and total bytes.
+        """
+        stats = {}
+        for record in self._records():
+            key = (record['type'], record['name'])
+            entry = stats.setdefault(key, {'type': key[0], 'name': key[1],
+                                           'count': 0, 'total': 0.0,
+                                           'max': 0.0, 'bytes': 0,
+                                           'cached': 0})
+            entry['count'] += 1
+            entry['total'] += record['elapsed']
+            entry['max'] = max(entry['max'], record['elapsed'])
+            entry['bytes'] += record.get('bytes', 0)
+            entry['cached'] += 1 if record.get('cached') else 0
+        for entry in stats.values():
+            entry['mean'] = entry['total'] / entry['count']
+        return sorted(stats.values(),
+                      key=lambda x: (x['type'], -x['total']))
+
+
+class TracingExtractor(object):
+    """ Wraps an extractor and records how long each page took to parse. """
+    def __init__(self, extractor, tracer):
+        self._extractor = extractor
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        attr = getattr(self._extractor, name)
+        if not callable(attr):
+            return attr
+
+        def traced(*args, **kwargs):
+            with self._tracer.span('parse', name):
+                return attr(*args, **kwargs)
+        return traced
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+import time
+
+import xbmc
+import xbmcaddon
+
+from resources.lib.config import (Settings, create_image_cache, create_mubi,
+                                  create_server, create_sync, create_tracer,
+                                  mubi_settings)
+
+PLUGIN_ID = 'plugin.video.mubi'
+PROFILE_PATH = xbmc.translatePath('special://profile/addon_data/%s/'
+                                  % PLUGIN_ID)
+
+
+def keep_running(*args):
+    return not xbmc.abortRequested
+
+
+def sync_catalog(mubi, settings):
+    interval = settings.get_int("sync_interval", 0) * 60 * 60
+    if not interval:
+        return
+    sync = create_sync(settings, mubi)
+    if time.time() - (sync.last_run() or 0) > interval:
+        sync.run(progress=keep_running)
+
+
+def serve(mubi, settings, server):
+    """ Start or stop serving `mubi` to the plugin, following the
+    settings. Returns the running server, if any.
+    """
+    if settings.get_bool("resident_service") and server is None:
+        server = create_server(settings, mubi,
+                               create_image_cache(settings, PROFILE_PATH))
+        server.start()
+    elif not settings.get_bool("resident_service") and server is not None:
+        stop(server)
+        server = None
+    return server
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
+
+
+def run():
+    mubi = None
+    mubi_key = None
+    server = None
+    while keep_running():
+        # Re-read the settings on every pass, they may have been changed
+        settings = Settings(xbmcaddon.Addon(PLUGIN_ID).getSetting)
+        # We only log in if the user has enabled the resident service or
+        # background updates of the catalog
+        wanted = (settings.get_bool("resident_service")
+                  or settings.get_int("sync_interval", 0))
+        if not (settings.get("username") and wanted):
+            if server is not None:
+                stop(server)
+                server = None
+            mubi = None
+        else:
+            try:
+                if mubi is None or mubi_settings(settings) != mubi_key:
+                    # Start over with the new account or limits, the
+                    # server still serves the old instance
+                    if server is not None:
+                        stop(server)
+                        server = None
+                    mubi = None
+                    mubi_key = mubi_settings(settings)
+                    mubi = create_mubi(settings, PROFILE_PATH,
+                                       create_tracer(settings, PROFILE_PATH))
+                server = serve(mubi, settings, server)
+            except Exception as e:
+                xbmc.log("MUBI: could not start the service: %s" % e)
+            if mubi is not None:
+                try:
+                    sync_catalog(mubi, settings)
+                except Exception as e:
+                    xbmc.log("MUBI: catalog update failed: %s" % e)
+        # Sleep in small steps so we notice when Kodi shuts down
+        for _ in range(60):
+            if not keep_running():
+                break
+            xbmc.sleep(1000)
+    if server is not None:
+        stop(server)
+
+
+if __name__ == '__main__':
+    run()